@@ -0,0 +1,81 @@
+""" Micro benchmark comparing the per character bciComms.tcpYielder against the
+buffered LineFramer. Run from the repository root:
+
+    python -m BCIFront.benchmarks.framing [frames] [packetSize]
+"""
+import sys
+import random
+from time import time
+from BCIFront.gui.bciHelper import bciComms, LineFramer
+
+def syntheticStream(frames, signals=2, channels=129):
+    """ Builds an app connector stream holding the given number of frames """
+    lines = []
+
+    for f in range(frames):
+        lines.append("SourceTime " + str((f * 500) % 65536))
+
+        for s in range(signals):
+            for c in range(channels):
+                lines.append("Signal(%d,%d) %f" % (s, c, random.random()))
+
+    return "\n".join(lines) + "\n", len(lines)
+
+def packets(stream, size):
+    """ Cuts the stream into tcp sized packets that ignore line boundaries """
+    return [stream[i:i+size] for i in range(0, len(stream), size)]
+
+def yielderLines(chunks):
+    """ The partial line stitching that every call site used to copy """
+    lastFull = True
+    last = ""
+    count = 0
+
+    for chunk in chunks:
+        for data, full in bciComms.tcpYielder(chunk):
+            if not full:
+                last += data
+                lastFull = False
+                continue
+            elif full and not lastFull:
+                lastFull = True
+                data = last + data
+                last = ""
+
+            count += 1
+
+    return count
+
+def framerLines(chunks):
+    framer = LineFramer()
+    count = 0
+
+    for chunk in chunks:
+        count += len(framer.feed(chunk))
+
+    return count
+
+def bench(func, chunks, expected):
+    start = time()
+    count = func(chunks)
+    elapsed = time() - start
+
+    if count != expected:
+        raise Exception("Expected " + str(expected) + " lines but got " + str(count))
+
+    return count / elapsed
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 65535
+
+    stream, numLines = syntheticStream(frames)
+    chunks = packets(stream, size)
+
+    old = bench(yielderLines, chunks, numLines)
+    new = bench(framerLines, chunks, numLines)
+
+    print "Lines:", numLines, "Packets:", len(chunks)
+    print "tcpYielder  = %.0f lines/sec" % old
+    print "LineFramer  = %.0f lines/sec" % new
+    print "Speedup     = %.1fx" % (new / old)
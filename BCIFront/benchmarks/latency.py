@@ -0,0 +1,209 @@
+""" End to end latency benchmark of the receive and decode path, from a frame arriving
+on the app connector socket to the decision being emitted. Synthetic frames are sent
+over a loopback connection and time stamped after every stage:
+
+    recv -> framing -> assembly -> publish -> window -> features -> predict -> emit
+
+Reports p50/p95/p99 per stage and end to end, plus the maximum sustainable decision
+rate, as JSON so runs can be compared across versions. Run from the repository root:
+
+    python -m BCIFront.benchmarks.latency [--frames N] [--rate R] [--output file.json]
+"""
+import json
+import socket
+import random
+import argparse
+import numpy
+from time import time, sleep
+from timeit import default_timer as timer
+from BCIFront.gui.bciHelper import bciComms, LineFramer, FrameAssembler
+from BCIFront.gui.bciRing import FrameRing, RingReader, SlidingWindow
+from BCIFront.classifier.naiveFormats import FormatJson
+from BCIFront.classifier.naive import NaiveBayes
+
+STAGES = ["recv", "framing", "assembly", "publish", "window", "features", "predict", "emit"]
+
+def frameLines(stamp, channels, peak):
+    """ Returns the app connector lines of one frame with extra power at the peak bin """
+    lines = ["SourceTime " + str(stamp % 65536)]
+
+    for c in range(channels):
+        value = random.gauss(1.0, 0.2) + (3.0 if c == peak else 0.0)
+        lines.append("Signal(0,%d) %f" % (c, value))
+
+    return lines
+
+def trainClassifier(freqList, channels, trials=10, frames=20):
+    """ Trains a classifier on synthetic frames so predict does realistic work
+
+    Return: (FormatJson, NaiveBayes)
+    """
+    data = {}
+
+    for t in range(trials):
+        data[t] = {}
+
+        for f in freqList:
+            lines = []
+            for i in range(frames):
+                lines.extend(frameLines(i * 500, channels, f))
+
+            data[t][str(f) + " Hz"] = bciComms.rawToDict(lines)
+
+    session = {"Data": data, "Collected Channels": freqList}
+    formater = FormatJson(session, loadDict=True)
+    labels, features = formater.features()
+    return formater, NaiveBayes(features, labels)
+
+def connect():
+    """ Return: the (sending, receiving) ends of a loopback tcp connection """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    sender = socket.create_connection(listener.getsockname())
+    sender.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    receiver, _ = listener.accept()
+    listener.close()
+    return sender, receiver
+
+def run(frames, rate, channels, freqList, window, hop):
+    """ Sends frames through the pipeline
+
+    Args:
+        frames: the number of frames to send after the warm up
+        rate: frames per second to send at, 0 for as fast as possible
+        channels: FFT bins per frame
+        freqList: the frequencies the classifier is trained on
+        window, hop: the SlidingWindow size. A decision is timed every hop frames
+
+    Return: (a dictionary of stage -> list of seconds spent per decision, end to end
+    seconds per decision)
+    """
+    formater, classifier = trainClassifier(freqList, channels)
+    ring = FrameRing(256, channels)
+    assembler = FrameAssembler()
+    assembler.subscribe(lambda frame: None, ring.setSchema)
+    framer = LineFramer()
+    sliding = None
+    emitted = []
+
+    sender, receiver = connect()
+
+    # Two cycles for the assembler to learn the layout, then enough to fill a window
+    warmup = 2 + window
+    texts = ["\n".join(frameLines(i * 500, channels, random.choice(freqList))) + "\n"
+             for i in range(frames + warmup)]
+
+    timings = dict((s, []) for s in STAGES)
+    total = []
+    decided = 0
+    start = timer()
+
+    for i, text in enumerate(texts):
+        if rate > 0:
+            wait = start + i / float(rate) - timer()
+            if wait > 0:
+                sleep(wait)
+
+        sent = timer()
+        sender.sendall(text)
+
+        received = 0
+        done = []
+        recvTime = framingTime = assemblyTime = 0.0
+
+        while received < len(text):
+            t = timer()
+            data = receiver.recv(65535)
+            t1 = timer()
+            lines = framer.feed(data)
+            t2 = timer()
+            done.extend(assembler.feed(lines))
+            t3 = timer()
+
+            received += len(data)
+            recvTime += t1 - t
+            framingTime += t2 - t1
+            assemblyTime += t3 - t2
+
+        if not done:
+            continue
+
+        t = timer()
+        ring.write(done[-1])
+        publishTime = timer() - t
+
+        if i < warmup:
+            continue
+
+        decided += 1
+        if (decided - 1) % hop:
+            continue
+
+        t = timer()
+        if sliding is None:
+            sliding = SlidingWindow(RingReader(ring, ring.written.value - window), window, hop)
+        sliding.next()
+        windowTime = timer() - t
+
+        t = timer()
+        features = formater.formatArray(sliding.average()[0])
+        featureTime = timer() - t
+
+        t = timer()
+        label, _ = classifier.predict(features)
+        predictTime = timer() - t
+
+        # Stands in for Communicate.txt.emit, which needs a running Qt application
+        t = timer()
+        emitted.append(label)
+        emitTime = timer() - t
+
+        for stage, spent in zip(STAGES, [recvTime, framingTime, assemblyTime, publishTime,
+                windowTime, featureTime, predictTime, emitTime]):
+            timings[stage].append(spent)
+
+        total.append(timer() - sent)
+
+    sender.close()
+    receiver.close()
+    return timings, total
+
+def percentiles(values):
+    values = numpy.array(values) * 1000.0 # ms
+    return {"p50": float(numpy.percentile(values, 50)),
+            "p95": float(numpy.percentile(values, 95)),
+            "p99": float(numpy.percentile(values, 99)),
+            "mean": float(values.mean())}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Receive to decision latency benchmark")
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=0,
+            help="frames per second to send, 0 for as fast as possible")
+    parser.add_argument("--channels", type=int, default=129)
+    parser.add_argument("--window", type=int, default=1)
+    parser.add_argument("--hop", type=int, default=1)
+    parser.add_argument("--label", default="", help="stored with the results, e.g. a version")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    timings, total = run(args.frames, args.rate, args.channels, [17, 20],
+            args.window, args.hop)
+
+    results = {"label": args.label, "time": time(), "frames": len(total),
+               "rate": args.rate, "channels": args.channels,
+               "window": args.window, "hop": args.hop,
+               "stages": dict((s, percentiles(timings[s])) for s in STAGES),
+               "endToEnd": percentiles(total),
+               "maxDecisionRate": len(total) / sum(total),
+               "maxFrameRate": len(total) * args.hop / sum(total)}
+
+    text = json.dumps(results, indent=4, separators=(',', ': '), sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+    print text
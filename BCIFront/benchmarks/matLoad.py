@@ -0,0 +1,74 @@
+""" Compares the vectorized FormatMat with the nested loop loader it replaced, on a
+synthetic matlab training file, and checks they give the same data. Run from the
+repository root:
+
+    python -m BCIFront.benchmarks.matLoad [trials] [chunks] [samples]
+"""
+import os
+import sys
+import tempfile
+import numpy
+import scipy.io
+from time import time
+from BCIFront.classifier.naiveFormats import FormatMat
+
+def syntheticMat(path, trials, chunks, labels=("12 Hz", "17 Hz", "20 Hz", "22 Hz"), bins=129):
+    """ Writes a matlab file holding a "Transformed" struct array of (label, data) with
+    data indexed [frequency Hz][FFT chunk][trial] """
+    transformed = numpy.zeros((1, len(labels)), dtype=[("label", "O"), ("data", "O")])
+
+    for i, label in enumerate(labels):
+        transformed[0, i] = (label, numpy.random.rand(bins, chunks, trials))
+
+    scipy.io.savemat(path, {"Transformed": transformed})
+
+def legacyFormat(trainingFile, samples=1):
+    """ The loader FormatMat used to be: tolist over the whole structure and nested
+    loops over trials, windows, frequencies and samples """
+    formatedList = []
+    matFile = scipy.io.loadmat(trainingFile)
+    dataList = matFile["Transformed"].tolist()[0]
+
+    for clss in dataList:
+        label = str(clss[0][0])
+        data = clss[1]
+        freq = int(label[:-3:1])
+        trials = len(data[1][1])
+
+        for j in range(trials):
+            for i in filter(lambda x: x % samples == 0, range(len(data[freq]) - samples + 1)):
+                merge = []
+
+                for f in range(freq - 10, freq + 10):
+                    for k in range(i, i+samples):
+                        merge.append(data[f][k][j])
+
+                formatedList.append((label, merge))
+
+    return formatedList
+
+if __name__ == '__main__':
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    samples = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+    handle, path = tempfile.mkstemp(suffix=".mat")
+    os.close(handle)
+    syntheticMat(path, trials, chunks)
+
+    start = time()
+    legacy = legacyFormat(path, samples)
+    legacyTime = time() - start
+
+    start = time()
+    formated = FormatMat(path, samples)
+    arrayTime = time() - start
+    data = formated.data()
+    listTime = time() - start
+
+    os.remove(path)
+
+    print "Rows:", len(legacy), "Same data:", legacy == data
+    print "legacy    %8.3f s" % legacyTime
+    print "FormatMat %8.3f s (%.3f s with data())" % (arrayTime, listTime)
+    print "Speed up  %8.1fx" % (legacyTime / max(arrayTime, 1e-9))
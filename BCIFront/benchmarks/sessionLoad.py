@@ -0,0 +1,94 @@
+""" Compares loading a training session from its json file, streaming it from its json
+file a trial at a time and loading it from the binary session format, in time and peak
+memory. Every load runs in a fresh interpreter
+so its peak resident size is its own. Run from the repository root:
+
+    python -m BCIFront.benchmarks.sessionLoad [trials] [frames] [sessions]
+"""
+import os
+import sys
+import json
+import random
+import resource
+import tempfile
+import subprocess
+from time import time
+from BCIFront.classifier.naiveFormats import FormatJson
+from BCIFront.classifier.sessionFile import SessionFile
+
+def syntheticSession(trials, frames, targets=("12 Hz", "17 Hz", "20 Hz", "22 Hz"), bins=129):
+    """ Builds a training dictionary like the one bciComms.processTrainData writes """
+    data = {}
+
+    for t in range(trials):
+        data[str(t)] = {}
+
+        for target in targets:
+            fft = dict((str(b), [random.random() for i in range(frames)]) for b in range(bins))
+            data[str(t)][target] = {"Raw FFT": fft}
+
+    return {"Data": data, "Collected Channels": [int(x.split(" ")[0]) for x in targets]}
+
+def load(paths, stream=False):
+    """ Loads and extracts the features of every path. When streaming, the rows are
+    only counted batch by batch instead of being kept
+
+    Return: (seconds, peak resident KB of the process, number of rows)
+    """
+    start = time()
+
+    if stream:
+        rows = sum(len(labels) for p in paths
+                for labels, _ in FormatJson.fromFile(p, stream=True).batches())
+    else:
+        rows = sum(len(FormatJson.fromFile(p).data()) for p in paths)
+
+    return time() - start, peakMemory(), rows
+
+def peakMemory():
+    """ Return: the peak resident KB of this process since it was started. ru_maxrss
+    would also count the memory of the process it was forked from """
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(paths, stream=False):
+    """ Runs load in a new interpreter and returns its result """
+    output = subprocess.check_output([sys.executable, "-m", "BCIFront.benchmarks.sessionLoad",
+            "--stream" if stream else "--load"] + paths)
+    return json.loads(output)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] in (["--load"], ["--stream"]):
+        print json.dumps(load(sys.argv[2:], sys.argv[1] == "--stream"))
+        sys.exit(0)
+
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    sessions = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    directory = tempfile.mkdtemp()
+    jsonPaths = []
+    binaryPaths = []
+
+    for s in range(sessions):
+        jsonPaths.append(os.path.join(directory, "%d.json" % s))
+        with open(jsonPaths[-1], "w") as f:
+            json.dump(syntheticSession(trials, frames), f, indent=4, separators=(',', ': '))
+
+        binaryPaths.append(os.path.join(directory, "%d%s" % (s, SessionFile.EXTENSION)))
+        SessionFile.fromJson(jsonPaths[-1], binaryPaths[-1])
+
+    for name, paths, stream in [("json", jsonPaths, False), ("stream", jsonPaths, True),
+            ("binary", binaryPaths, False)]:
+        size = sum(os.path.getsize(p) for p in paths)
+        elapsed, rss, rows = measure(paths, stream)
+        print "%-6s %8.1f MB on disk, %7.3f s, %8.1f MB peak RSS, %d rows" % (name,
+                size / 1048576.0, elapsed, rss / 1024.0, rows)
+
+    for p in jsonPaths + binaryPaths:
+        os.remove(p)
+    os.rmdir(directory)
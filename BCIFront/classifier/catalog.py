@@ -0,0 +1,285 @@
+""" A local catalog of training sessions. Session files, json or binary, are indexed by
+subject, date, collected frequencies, targets, trial count and format, so sessions can
+be selected with a query instead of by hand and their features, taken from the
+FeatureCache, combined into one data set. Run from the repository root:
+
+    python -m BCIFront.classifier.catalog scan directory [--subject name]
+    python -m BCIFront.classifier.catalog find [--subject name] [--days 30] [--frequencies 17 20]
+"""
+import os
+import sys
+import json
+import argparse
+import numpy
+from datetime import datetime, date, timedelta
+from sessionFile import SessionFile
+from naiveFormats import JsonTrialStream, FormatArrays
+from featureCache import FeatureCache
+
+class SessionCatalog():
+    """ An index of session files kept in a json file. Each entry is a dictionary of
+    what is known about one session, keyed by the absolute path of its file. Entries
+    are only read again from the session file when its size or modification time
+    changes """
+    PATH = os.path.join(os.path.expanduser("~"), ".bcifront", "catalog.json")
+
+    def __init__(self, path=None, cache=None):
+        """ Args:
+            path: the catalog file. Defaults to ~/.bcifront/catalog.json
+            cache: the FeatureCache features are taken from. Defaults to the default
+            FeatureCache
+
+        Throws: Exception if the catalog file cannot be parsed
+        """
+        self.path = path or SessionCatalog.PATH
+        self.cache = cache
+        self.sessions = {}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.sessions = json.load(f)
+            except ValueError as e:
+                raise Exception("Couldnt parse catalog file!", e)
+
+    def save(self):
+        """ Writes the catalog file """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.sessions, f, indent=4, separators=(',', ': '), sort_keys=True)
+
+        os.rename(self.path + ".tmp", self.path)
+
+    @classmethod
+    def describe(cls, path, subject=None):
+        """ Reads the catalog entry of a session file. A json session is streamed once
+        to count its trials and targets
+
+        Args:
+            path: the session file
+            subject: overrides the subject of the session. Otherwise it is taken from
+            the header of a binary session or is the name of the containing directory
+
+        Throws: Exception if the file is not a session
+        """
+        if path.endswith(SessionFile.EXTENSION):
+            session = SessionFile(path)
+            entry = {"format": "binary", "subject": session.subject, "date": session.date,
+                     "frequencies": session.freqList, "targets": session.targets,
+                     "trials": session.trials}
+        else:
+            targets = set()
+            trials = 0
+
+            for trial, tData in JsonTrialStream(path).trials():
+                targets.update(tData.keys())
+                trials += 1
+
+            entry = {"format": "json", "subject": None, "date": None,
+                     "frequencies": JsonTrialStream.collectedChannels(path),
+                     "targets": sorted(targets), "trials": trials}
+
+        modified = os.path.getmtime(path)
+        entry["subject"] = (subject or entry["subject"] or
+                os.path.basename(os.path.dirname(os.path.abspath(path))))
+        entry["date"] = entry["date"] or datetime.fromtimestamp(modified).isoformat()
+        entry["path"] = path
+        entry["size"] = os.path.getsize(path)
+        entry["modified"] = modified
+        entry["hash"] = FeatureCache.fileHash(path)
+        return entry
+
+    def add(self, path, subject=None):
+        """ Adds a session file, or updates its entry if the file changed
+
+        Return: the entry of the session
+        """
+        path = os.path.abspath(path)
+        entry = self.sessions.get(path)
+
+        if (entry is None or entry["size"] != os.path.getsize(path) or
+                entry["modified"] != os.path.getmtime(path) or
+                (subject and subject != entry["subject"])):
+            entry = self.describe(path, subject)
+            self.sessions[path] = entry
+
+        return entry
+
+    def scan(self, directory, subject=None):
+        """ Adds every session below directory and drops the entries of files that no
+        longer exist. Json files that are not sessions, like config.json, are skipped
+
+        Return: the number of sessions found below directory
+        """
+        found = 0
+
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not (name.endswith(".json") or name.endswith(SessionFile.EXTENSION)):
+                    continue
+
+                try:
+                    self.add(os.path.join(root, name), subject)
+                    found += 1
+                except Exception:
+                    continue
+
+        for path in [p for p in self.sessions if not os.path.exists(p)]:
+            del self.sessions[path]
+
+        return found
+
+    @classmethod
+    def dateString(cls, when):
+        """ Return: when, a date, datetime or string, as an ISO 8601 string """
+        if isinstance(when, (date, datetime)):
+            return when.isoformat()
+
+        return str(when)
+
+    def find(self, subject=None, since=None, until=None, frequencies=None, format=None,
+            minTrials=0):
+        """ Finds the sessions matching every given condition
+
+        Args:
+            subject: the subject of the session
+            since, until: the first and last day or time of the session, inclusive
+            frequencies: the frequencies collected on, in any order. The session must
+            have collected exactly these
+            format: "json" or "binary"
+            minTrials: the fewest trials the session must have
+
+        Return: the matching entries, oldest first
+        """
+        since = self.dateString(since) if since is not None else None
+        until = self.dateString(until) if until is not None else None
+        frequencies = sorted(frequencies) if frequencies is not None else None
+        found = []
+
+        for entry in self.sessions.values():
+            if subject is not None and entry["subject"] != subject:
+                continue
+
+            # ISO dates compare in time order. until only needs to match as far as it
+            # is given, so a day includes the whole of that day
+            if since is not None and entry["date"] < since:
+                continue
+
+            if until is not None and entry["date"][:len(until)] > until:
+                continue
+
+            if frequencies is not None and sorted(entry["frequencies"]) != frequencies:
+                continue
+
+            if format is not None and entry["format"] != format:
+                continue
+
+            if entry["trials"] < minTrials:
+                continue
+
+            found.append(entry)
+
+        return sorted(found, key=lambda e: e["date"])
+
+    def features(self, entries, samples=1, numHarms=0, epsilon=2):
+        """ Combines the cached features of sessions into one data set. A session not
+        cached yet is extracted and cached first
+
+        Args:
+            entries: entries returned by find
+            samples, numHarms, epsilon: the extraction parameters, see FormatJson
+
+        Return: a FormatArrays of the rows of every session, in order
+
+        Throws: Exception if there are no sessions, a session no longer exists or they
+        collected on different frequencies, which gives features that cannot be combined
+        """
+        if not entries:
+            raise Exception("No sessions")
+
+        # A session changed since it was scanned is described again, so its features
+        # are not looked up, or cached, under the hash of its old contents
+        refreshed = []
+
+        for entry in entries:
+            try:
+                refreshed.append(self.add(entry["path"], entry["subject"]))
+            except OSError as e:
+                raise Exception("Session no longer exists: " + entry["path"], e)
+
+        entries = refreshed
+
+        freqList = sorted(entries[0]["frequencies"])
+
+        for entry in entries:
+            if sorted(entry["frequencies"]) != freqList:
+                raise Exception("Sessions collected on different frequencies: " +
+                        str(freqList) + " and " + str(sorted(entry["frequencies"])))
+
+        cache = self.cache or FeatureCache()
+        labels = []
+        values = []
+
+        for entry in entries:
+            formater = cache.load(entry["path"], samples, numHarms, epsilon, entry["hash"])
+            l, v = formater.features()
+
+            # Every frequency has a block of columns, in the order of the session's own
+            # freqList, so the blocks are put in the order of the sorted one
+            width = v.shape[1] // len(formater.freqList)
+            columns = numpy.concatenate([numpy.arange(i * width, (i + 1) * width)
+                    for i in [formater.freqList.index(f) for f in freqList]])
+
+            labels.append(l)
+            values.append(v[:, columns])
+
+        return FormatArrays(numpy.concatenate(labels), numpy.concatenate(values), freqList,
+                samples, numHarms, epsilon)
+
+    def query(self, samples=1, numHarms=0, epsilon=2, **conditions):
+        """ Same as features(find(**conditions), samples, numHarms, epsilon) """
+        return self.features(self.find(**conditions), samples, numHarms, epsilon)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index and query training sessions")
+    parser.add_argument("--catalog", help="the catalog file to use")
+    commands = parser.add_subparsers(dest="command")
+
+    scan = commands.add_parser("scan", help="index every session below a directory")
+    scan.add_argument("directory")
+    scan.add_argument("--subject", help="the subject of every session found")
+
+    find = commands.add_parser("find", help="list the sessions matching a query")
+    find.add_argument("--subject")
+    find.add_argument("--since", help="first day, YYYY-MM-DD")
+    find.add_argument("--until", help="last day, YYYY-MM-DD")
+    find.add_argument("--days", type=int, help="only the sessions of the last days")
+    find.add_argument("--frequencies", type=int, nargs="+")
+    find.add_argument("--format", choices=["json", "binary"])
+    find.add_argument("--features", action="store_true",
+            help="also build the combined features of the sessions")
+    args = parser.parse_args()
+
+    catalog = SessionCatalog(args.catalog)
+
+    if args.command == "scan":
+        print "Found", catalog.scan(args.directory, args.subject), "sessions"
+        catalog.save()
+        sys.exit(0)
+
+    since = args.since
+    if args.days is not None:
+        since = date.today() - timedelta(days=args.days)
+
+    entries = catalog.find(args.subject, since, args.until, args.frequencies, args.format)
+
+    for e in entries:
+        print "%-19s %-12s %-6s %3d trials %-16s %s" % (e["date"][:19], e["subject"],
+                e["format"], e["trials"], e["frequencies"], e["path"])
+
+    if args.features and entries:
+        formater = catalog.features(entries)
+        print "Features:", formater.values.shape, "from", len(entries), "sessions"
@@ -1,6 +1,6 @@
 import sys
 from naive import NaiveBayes
-from naiveFormats import FormatJson
+from featureCache import FeatureCache
 import matplotlib.pyplot as pl
 import numpy as np
 import matplotlib.mlab as mlab
@@ -38,9 +38,11 @@ def plotDists(naive, labels):
     toPlot = []
 
     for l in labels:
-        for i in range(len(naive.mean[l])):
-            mean = naive.mean[l][i][0]
-            std = naive.stdv[l][i][0]
+        c = naive.labels.index(l)
+
+        for i in range(naive.num):
+            mean = naive.mean[c][i]
+            std = naive.stdv[c][i]
             toPlot.append((mean,std))
 
             if mean < minMean:
@@ -58,24 +60,27 @@ def plotDists(naive, labels):
     for m, s in toPlot:
         normDist(m,s,l,r)
 
-formt = FormatJson(sys.argv[1])
-naive = NaiveBayes(formt.data())
-print "Total Accuracy (cross validate) = " +  str(naive.crossValidate(10))
-
-labels = formt.channels()
-counts = [[0]*len(labels) for i in range(len(labels))]
-
-for label, data in formt.data():
-    expectedChn, _ = naive.predict(data)
-
-    # Confusion matrix
-    correct = labels.index(label)
-    actual = labels.index(expectedChn)
-    counts[correct][actual] += 1
-
-print counts
-labels = [''] + labels
-confusion(labels, counts)
-plotDists(naive, labels[1:])
-pl.show()
-
+# crossValidate starts a process pool, whose workers import this script again on
+# Windows
+if __name__ == '__main__':
+    formt = FeatureCache().load(sys.argv[1])
+    labels, features = formt.features()
+    naive = NaiveBayes(features, labels)
+    print "Total Accuracy (cross validate) = " +  str(naive.crossValidate(10))
+
+    labels = formt.channels()
+    counts = [[0]*len(labels) for i in range(len(labels))]
+
+    for label, data in formt.data():
+        expectedChn, _ = naive.predict(data)
+
+        # Confusion matrix
+        correct = labels.index(label)
+        actual = labels.index(expectedChn)
+        counts[correct][actual] += 1
+
+    print counts
+    labels = [''] + labels
+    confusion(labels, counts)
+    plotDists(naive, labels[1:])
+    pl.show()
@@ -0,0 +1,156 @@
+""" A persistent cache of extracted features, so analysing the same sessions again skips
+parsing them. Entries are keyed by the content of the session file and the extraction
+parameters, and the least recently used entries are removed once the cache grows past
+its size limit.
+"""
+import os
+import hashlib
+import zipfile
+import tempfile
+import numpy
+from naiveFormats import FormatJson, FormatArrays
+
+class FeatureCache():
+    """ A directory of .npz files each holding the labels, features and collected
+    frequencies of one session extracted with one set of parameters """
+    # Changing how features are extracted must change this so old entries are not used
+    VERSION = 1
+    # The prefix of entries still being written, which evict leaves alone
+    TEMPORARY = ".tmp-"
+    DIRECTORY = os.path.join(os.path.expanduser("~"), ".bcifront", "features")
+
+    def __init__(self, directory=None, maxBytes=512 * 1024 * 1024):
+        """ Args:
+            directory: where the entries are kept. Defaults to ~/.bcifront/features
+            maxBytes: the size the entries are trimmed to after every new entry
+        """
+        self.directory = directory or FeatureCache.DIRECTORY
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @classmethod
+    def fileHash(cls, path, chunkSize=1 << 20):
+        """ Return: the sha1 hex digest of the content of the file """
+        digest = hashlib.sha1()
+
+        with open(path, "rb") as f:
+            chunk = f.read(chunkSize)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(chunkSize)
+
+        return digest.hexdigest()
+
+    def key(self, path, samples=1, numHarms=0, epsilon=2, digest=None):
+        """ Return: the name of the entry of a session file and extraction parameters.
+        digest is the fileHash of path if it is already known """
+        return "%s-v%d-s%d-h%d-e%d" % (digest or FeatureCache.fileHash(path),
+                FeatureCache.VERSION, samples, numHarms, epsilon)
+
+    def entry(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """ Return: (labels, features, freqList) of the entry or None if it is not cached """
+        entry = self.entry(key)
+
+        try:
+            with open(entry, "rb") as f:
+                cached = numpy.load(f)
+                result = (cached["labels"], cached["features"], cached["freqList"].tolist())
+        except (IOError, EOFError, KeyError, ValueError, zipfile.BadZipfile):
+            # A corrupt or truncated entry is a miss, and is replaced once re-extracted
+            return None
+
+        # The modification time orders the entries for eviction
+        os.utime(entry, None)
+        return result
+
+    def put(self, key, labels, features, freqList):
+        """ Stores an entry and evicts the least recently used ones past maxBytes """
+        # Written under a temporary name so other processes never load half an entry
+        handle, temporary = tempfile.mkstemp(suffix=".npz",
+                prefix=FeatureCache.TEMPORARY, dir=self.directory)
+
+        with os.fdopen(handle, "wb") as f:
+            numpy.savez(f, labels=labels, features=features, freqList=numpy.array(freqList))
+
+        entry = self.entry(key)
+
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            # Windows does not rename over an existing file, such as an unreadable entry
+            # or one another process just stored
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+
+            os.rename(temporary, entry)
+
+        self.evict(entry)
+
+    def evict(self, keep=None):
+        """ Removes the least recently used entries until the cache fits in maxBytes. The
+        entry keep is never removed, even if it alone is larger than maxBytes. Entries
+        other processes are still writing are neither counted nor removed """
+        entries = []
+
+        for name in os.listdir(self.directory):
+            if name.startswith(FeatureCache.TEMPORARY) or not name.endswith(".npz"):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            total -= size
+
+    def load(self, path, samples=1, numHarms=0, epsilon=2, digest=None):
+        """ Returns the features of a session file, extracting and storing them if they
+        are not cached
+
+        Args:
+            path: a json or binary session file
+            samples, numHarms, epsilon: the extraction parameters, see FormatJson
+            digest: the fileHash of path if it is already known, so a hit does not
+            read the file at all
+
+        Return: a FormatArrays holding the features
+        """
+        key = self.key(path, samples, numHarms, epsilon, digest)
+        cached = self.get(key)
+
+        if cached is None:
+            self.misses += 1
+            formater = FormatJson.fromFile(path, samples, numHarms, epsilon)
+            labels, features = formater.features()
+            cached = (labels, features, formater.freqList)
+            self.put(key, *cached)
+        else:
+            self.hits += 1
+
+        labels, features, freqList = cached
+        return FormatArrays(labels, features, freqList, samples, numHarms, epsilon)
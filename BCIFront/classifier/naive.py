@@ -1,51 +1,195 @@
 import scipy.io
 import numpy
-import scipy.stats
 import sys
-from naiveFormats import FormatJson
+from multiprocessing import Pool, cpu_count
+from featureCache import FeatureCache
 
 class NaiveBayes:
+    # The log of the smallest density a normal pdf returns before it underflows
+    # to 0. The per feature predict used to skip those densities, they still are so
+    # predictions match
+    LOG_UNDERFLOW = numpy.log(numpy.finfo(numpy.float64).tiny * numpy.finfo(numpy.float64).eps)
 
-    # Take list of [tuple ("class", [data0, data1,...,dataN])]
-    def __init__(self, trainingData):
-        NaiveBayes.checkTrainData(trainingData)
+    # The most rows scored at once by predictMany, which bounds its memory
+    BATCH = 4096
 
-        self.trainingData = trainingData
+    def __init__(self, trainingData=None, labels=None):
+        """ Trains the classifier
+
+        Args:
+            trainingData: a list of tuples ("class", [data0, data1,...,dataN]), or an
+            (n, features) array when labels is given. If None the classifier is left
+            untrained, for setStatistics
+            labels: the class of each row of the trainingData array
+
+        Throws: Exception if the data is not formated as above
+        """
         self.predictThreshold = .95
-        self.priors = {}
-        self.num= len(trainingData[0][1])
-        self.mean = {}
-        self.stdv = {}
+        self.trainingFeatures = None
+        self.trainingLabels = None
+
+        if trainingData is None:
+            return
+
+        if labels is None:
+            NaiveBayes.checkTrainData(trainingData)
+            labels = [l for l, d in trainingData]
+            trainingData = [d for l, d in trainingData]
+
+        self.trainingFeatures = numpy.asarray(trainingData, dtype=numpy.float64)
+        self.trainingLabels = numpy.array([str(l) for l in labels])
+
+        if self.trainingFeatures.ndim != 2 or not len(self.trainingFeatures):
+            raise Exception("Training data must be a non empty (n, features) array")
+
+        if len(self.trainingLabels) != len(self.trainingFeatures):
+            raise Exception("Not every row of the training data has a label")
 
-        for (label, data) in trainingData:
-            # Build up the priors by counting occurances of each class
-            if self.priors.has_key(label):
-                self.priors[label] += 1
-                [self.mean[label][i].append(data[i]) for i in range(self.num)]
+        self.fit(self.trainingFeatures, self.trainingLabels)
 
-                # builds up an array of arrays containing each value for the
-                # feature
-                [self.stdv[label][i].append(data[i]) for i in range(self.num)]
-            else:
-                self.priors[label] = 1
-                self.mean[label] = [[i] for i in data]
-                self.stdv[label] = [[i] for i in data]
+    def fit(self, features, labels):
+        """ Computes the statistics of every class from an (n, features) array and the
+        label of each row """
+        classes = numpy.unique(labels).tolist()
+        counts, mean, m2 = NaiveBayes.classStatistics(features, labels, classes)
+        self.setStatistics(classes, counts, mean, m2)
 
+    @classmethod
+    def classStatistics(cls, features, labels, classes):
+        """ Return: (counts, mean, m2), the number of rows, the (classes, features)
+        means and sums of squared deviations of the rows of each of classes, in that
+        order. Classes without rows have a count, mean and m2 of 0 """
+        counts = numpy.zeros(len(classes))
+        mean = numpy.zeros((len(classes), features.shape[1]))
+        m2 = numpy.zeros((len(classes), features.shape[1]))
 
-        # Post processing
-        for label in self.priors.keys():
-            # Calculate the prior probability
-            self.priors[label] = self.priors[label] / float(len(trainingData))
+        for c, label in enumerate(classes):
+            rows = features[labels == label]
 
-            # REMOVE DATA ABOVE x STD DEVIATIONS FROM MEAN AND RECALCULATE
-            for i,l in enumerate(self.mean[label]):
-                std = numpy.std(l)
-                mean = numpy.mean(l)
-                self.mean[label][i] = filter(lambda y: y <= mean+3*std or y >= mean-3*std, l)
+            if len(rows):
+                counts[c] = len(rows)
+                mean[c] = rows.mean(axis=0)
+                m2[c] = ((rows - mean[c]) ** 2).sum(axis=0)
 
-                self.stdv[label][i] = [numpy.std(self.mean[label][i])]
-                self.mean[label][i] = [numpy.mean(self.mean[label][i])]
+        return counts, mean, m2
 
+    @classmethod
+    def removeStatistics(cls, total, part):
+        """ Takes the statistics of some rows out of the statistics of all of them, the
+        reverse of the merge in partialFit
+
+        Args:
+            total, part: (counts, mean, m2) of the same classes, as from classStatistics
+
+        Return: (counts, mean, m2) of the rows that are not in part
+        """
+        counts, mean, m2 = total
+        partCounts, partMean, partM2 = part
+        rest = counts - partCounts
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            restMean = counts[:, None] * mean - partCounts[:, None] * partMean
+            restMean /= rest[:, None]
+            delta = partMean - restMean
+            restM2 = m2 - partM2 - delta * delta * (partCounts * rest / counts)[:, None]
+
+        # Classes left without rows, and rounding below 0
+        restMean[rest == 0] = 0
+        restM2[rest == 0] = 0
+        return rest, restMean, numpy.maximum(restM2, 0)
+
+    def setStatistics(self, labels, counts, mean, m2):
+        """ Sets the statistics the classifier predicts from
+
+        Args:
+            labels: the classes
+            counts: the number, or total weight, of the rows of each class
+            mean, m2: the (classes, features) means and sums of squared deviations
+        """
+        self.labels = list(labels)
+        self.counts = numpy.asarray(counts, dtype=numpy.float64)
+        self.mean = numpy.asarray(mean, dtype=numpy.float64)
+        self.m2 = numpy.asarray(m2, dtype=numpy.float64)
+        self.num = self.mean.shape[1]
+        self.update()
+
+    def update(self):
+        """ Derives the priors, standard deviations and the constants of the log
+        likelihood from the counts, means and sums of squared deviations of the classes.
+
+        Predictions only read the classifier through model, a tuple of the labels and
+        (classes, features) arrays that is replaced in a single assignment once they are
+        all derived. A predict running in another thread while the classifier is updated
+        uses either the old or the new classifier, never a mix of the two
+        """
+        self.priors = dict(zip(self.labels, (self.counts / self.counts.sum()).tolist()))
+        self.stdv = numpy.sqrt(self.m2 / self.counts[:, None])
+        self.precompute()
+        self.model = (self.labels, self.mean, self.invVar, self.logNorm, self.logPriors)
+
+    def partialFit(self, features, labels, forgetting=1.0):
+        """ Folds new labelled rows into the statistics of their classes without
+        retraining, with Welford's update merged over the rows of each class. This is
+        O(features) per row and the rows are not kept, so crossValidate still uses only
+        the training data
+
+        Args:
+            features: an (n, features) array or a single row of features
+            labels: the class of each row, or a single class for every row
+            forgetting: in (0, 1], what every class's past counts are weighted by for
+            each new row. Below 1 older rows fade exponentially so the model follows
+            drift within a session, 1 weights every row the same
+        """
+        features = numpy.asarray(features, dtype=numpy.float64).reshape(-1, self.num)
+
+        if isinstance(labels, basestring):
+            labels = [labels] * len(features)
+
+        labels = numpy.array([str(l) for l in labels])
+
+        if len(labels) != len(features):
+            raise Exception("Not every row of the features has a label")
+
+        if not 0 < forgetting <= 1:
+            raise Exception("forgetting must be in (0, 1]")
+
+        # New arrays rather than in place, so the model a predict in another thread is
+        # using is left as it is, see update
+        weight = forgetting ** len(features)
+        counts = self.counts * weight
+        mean = self.mean.copy()
+        m2 = self.m2 * weight
+        classLabels = list(self.labels)
+
+        for label in numpy.unique(labels).tolist():
+            rows = features[labels == label]
+
+            if label not in classLabels:
+                classLabels.append(label)
+                counts = numpy.append(counts, 0.0)
+                mean = numpy.vstack((mean, numpy.zeros(self.num)))
+                m2 = numpy.vstack((m2, numpy.zeros(self.num)))
+
+            c = classLabels.index(label)
+            rowsMean = rows.mean(axis=0)
+            delta = rowsMean - mean[c]
+            total = counts[c] + len(rows)
+
+            m2[c] += ((rows - rowsMean) ** 2).sum(axis=0)
+            m2[c] += delta * delta * counts[c] * len(rows) / total
+            mean[c] += delta * len(rows) / total
+            counts[c] = total
+
+        self.labels, self.counts, self.mean, self.m2 = classLabels, counts, mean, m2
+        self.update()
+
+    def precompute(self):
+        """ Computes the per class constants of the log likelihood from the mean, stdv
+        and priors """
+        with numpy.errstate(divide="ignore"):
+            self.logPriors = numpy.log([self.priors[l] for l in self.labels])
+            self.invVar = 1.0 / (self.stdv * self.stdv)
+            self.logNorm = -numpy.log(self.stdv) - 0.5 * numpy.log(2 * numpy.pi)
 
     @classmethod
     def checkTrainData(cls, data):
@@ -73,41 +217,57 @@ class NaiveBayes:
 
 
     def predict(self, features):
+        """ Classifies one row of features
+
+        Return: (the most likely label, a dictionary of label -> probability)
+        """
         if len(features) != self.num:
             raise Exception("Wrong number of features. Can't predict")
 
-        probs = self.priors.copy()
+        return self.predictMany([features])[0]
+
+    def predictMany(self, features):
+        """ Classifies every row of a (rows, features) array at once
+
+        Return: a list of (the most likely label, a dictionary of label -> probability),
+        one for each row
+        """
+        model = self.model
+        labels = model[0]
+        probs = self.probabilities(features, model)
+        best = probs.argmax(axis=1)
+
+        return [(labels[b], dict(zip(labels, p))) for b, p in zip(best, probs.tolist())]
+
+    def probabilities(self, features, model=None):
+        """ Return: the (rows, classes) probabilities of every row of a (rows, features)
+        array, with the classes in the order of the labels of model, which defaults to
+        the current one """
+        logProbs = self.logLikelihoods(features, model)
 
-        for label in probs.keys():
-            probs[label] = numpy.log(probs[label])
+        # log-sum-exp, so no class overflows or underflows to 0 for all of them
+        logProbs = logProbs - logProbs.max(axis=1)[:, None]
+        probs = numpy.exp(logProbs)
+        return probs / probs.sum(axis=1)[:, None]
 
-            for i in range(self.num):
-                curProb = scipy.stats.norm.pdf(features[i], self.mean[label][i],
-                                               self.stdv[label][i])
+    def logLikelihoods(self, features, model=None):
+        """ Return: the (rows, classes) log prior plus log likelihood of every row of a
+        (rows, features) array under model, which defaults to the current one """
+        labels, mean, invVar, logNorm, logPriors = model or self.model
+        features = numpy.asarray(features, dtype=numpy.float64).reshape(-1, self.num)
+        logProbs = numpy.empty((len(features), len(labels)))
 
-                if curProb <= 0:
-                    print "Not possible for pdf to return -> " + str(curProb)
-                    continue
-                probs[label] += numpy.log(curProb)
+        for start in range(0, len(features), NaiveBayes.BATCH):
+            rows = features[start:start + NaiveBayes.BATCH]
 
-        norm = None
-        results = [(probs[l], l) for l in probs.keys()]
-        try:
-            probs = numpy.array([e[0] for e in results])
-            zeroize = numpy.mean(probs)
-            probs = probs + zeroize # Shift means of logged elements to zero
-            probs = numpy.exp(probs)
+            # (rows, classes, features) log densities of every feature under every class
+            diff = rows[:, None, :] - mean[None, :, :]
+            logPdf = logNorm - 0.5 * diff * diff * invVar
+            logPdf[logPdf < NaiveBayes.LOG_UNDERFLOW] = 0
 
-            # Does not make sense to remove because then you dont know what
-            # classes exist anymore
-            # probs = filter(lambda x: float(x) != float('inf'), probs) # Get rid of super large values after exponentiation
-            norm = probs / sum(probs)
-        except Exception:
-            norm = numpy.array([0])
+            logProbs[start:start + len(rows)] = logPriors + logPdf.sum(axis=2)
 
-        # "class", dict("class", probability)]
-        classProbs = map(lambda (a,b): (a,b[0]), zip([r[1] for r in results], norm.tolist()))
-        return max(classProbs, key=lambda x: x[1])[0], dict(classProbs)
+        return logProbs
 
     @classmethod
     def kFoldGen(cls, X, K):
@@ -118,31 +278,91 @@ class NaiveBayes:
 
 
     # Data is the formated training data and k is the chunks to break it into
-    def crossValidate(self, K):
-        correct = 0
-        total = 0
+    def crossValidate(self, K, processes=None):
+        """ Return: the percentage of the training rows predicted right by classifiers
+        trained on the other folds, see crossPredict """
+        predicted, _ = self.crossPredict(K, processes)
+        correct = int(numpy.sum(predicted == self.trainingLabels))
 
-        for train, val in NaiveBayes.kFoldGen(self.trainingData, K):
-            classy = NaiveBayes(train)
+        perc = correct / float(len(self.trainingLabels)) * 100
 
-            for trial in val:
-                total += 1
-                res, _ = classy.predict(trial[1])
+        return perc
 
-                if res == trial[0]:
-                    correct += 1
+    def crossPredict(self, K, processes=None):
+        """ Predicts every training row with a classifier trained on the other folds,
+        the same folds as kFoldGen. The class statistics of every fold are computed once
+        and each fold's classifier is the total less its fold, so no rows are copied to
+        train it. The folds are validated in a pool of processes, or in this process if
+        processes is 1
 
-        perc = correct / float(total) * 100
+        Return: (predicted, confidence) arrays of the predicted label of every training
+        row and its probability
+        """
+        if self.trainingFeatures is None:
+            raise Exception("Not trained from data. Can't cross validate")
 
-        return perc
+        features, labels = self.trainingFeatures, self.trainingLabels
+        folds = numpy.arange(len(features)) % K
+        total = NaiveBayes.classStatistics(features, labels, self.labels)
+        jobs = []
+
+        for k in range(K):
+            held = folds == k
+            part = NaiveBayes.classStatistics(features[held], labels[held], self.labels)
+            jobs.append((self.labels, NaiveBayes.removeStatistics(total, part),
+                    features[held]))
+
+        processes = min(K, cpu_count()) if processes is None else processes
+
+        if processes <= 1:
+            results = map(validateFold, jobs)
+        else:
+            pool = Pool(processes)
+            try:
+                results = pool.map(validateFold, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        predicted = numpy.empty(len(features), dtype=labels.dtype)
+        confidence = numpy.empty(len(features))
+
+        for k, (foldPredicted, foldConfidence) in enumerate(results):
+            predicted[folds == k] = foldPredicted
+            confidence[folds == k] = foldConfidence
+
+        return predicted, confidence
+
+def validateFold(fold):
+    """ Trains a classifier from the statistics of a fold's training rows and predicts
+    its validation rows. A function so a process pool can run it
+
+    Args:
+        fold: (labels, (counts, mean, m2), validation features)
+
+    Return: (predicted labels, probability of each predicted label)
+    """
+    labels, (counts, mean, m2), features = fold
+
+    # Classes with no training rows in this fold are left out, as training on the
+    # rows would
+    keep = counts > 0
+    classy = NaiveBayes()
+    classy.setStatistics([l for l, k in zip(labels, keep) if k], counts[keep], mean[keep],
+            m2[keep])
+
+    probs = classy.probabilities(features)
+    best = probs.argmax(axis=1)
+    return [classy.labels[b] for b in best], probs[numpy.arange(len(best)), best]
 
 
 if __name__ == '__main__':
     if (len(sys.argv) < 2):
         sys.exit(0)
 
-    formated = FormatJson(sys.argv[1])
-    classy = NaiveBayes(formated.formatedList)
+    formated = FeatureCache().load(sys.argv[1])
+    labels, features = formated.features()
+    classy = NaiveBayes(features, labels)
     perc = classy.crossValidate(10)
     print sys.argv[1]
     print "Total Accuracy = " +  str(perc)
@@ -1,5 +1,8 @@
+import re
 import json
+import numpy
 import scipy.io
+from sessionFile import SessionFile
 
 class FormatMat:
     """ Takes a matlab training file and processes it in a way the NaiveBayes
@@ -12,36 +15,31 @@ class FormatMat:
 
         Args: trainingFile is the path to the *.mat file
         """
-        self.formatedList = []
-        matFile = scipy.io.loadmat(trainingFile)
+        # Only the variable that is used is read from the file
+        matFile = scipy.io.loadmat(trainingFile, variable_names=["Transformed"])
 
         # Each index contains a unique label and the associated data
         # dataList[class][0=label, 1=data][frequency Hz][FFT chunks][Trial #]
-        dataList = matFile["Transformed"].tolist()[0]
+        dataList = matFile["Transformed"][0]
+
+        labels = []
+        features = []
 
         for clss in dataList:
             label = str(clss[0][0])
-            data = clss[1]
+            data = numpy.asarray(clss[1])
 
             # Need to parse label to determine frequency of interest
             # Removing " Hz" from end
             freq = int(label[:-3:1])
 
-            # Generate ("label", [fft0,..., fftN]) for each trial
-            trials = len(data[1][1])
-
-            # Sample number of fft data points from each frequency window
-            for j in range(trials):
-                for i in filter(lambda x: x % samples == 0, range(len(data[freq]) - samples + 1)):
-
-                    # Makes a list of sample data points * number of frequencies of interest
-                    merge = []
+            # The 20 bins around the frequency of interest of every trial as
+            # (trial, frequency, FFT chunk), cut into windows of samples chunks. Gives
+            # ("label", [fft0,..., fftN]) for each window of each trial
+            window = FormatJson.windows(data[freq - 10:freq + 10].transpose(2, 0, 1), samples)
 
-                    for f in range(freq - 10, freq + 10):
-                        for k in range(i, i+samples):
-                            merge.append(data[f][k][j])
-
-                    self.formatedList.append((label, merge))
+            features.append(window.reshape(-1, window.shape[-1]))
+            labels.extend([label] * len(features[-1]))
 
             # The full frequency window for each data point
             #for i in range(trials):
@@ -54,10 +52,21 @@ class FormatMat:
                 ## Remove the first value which is the start of the trial
                 #self.formatedList.append((label, trialData))
 
+        self.labels = numpy.array(labels)
+        self.values = numpy.concatenate(features)
+        self.formatedList = None
+
+    def features(self):
+        """ Return: the formated data as (labels, features) arrays """
+        return self.labels, self.values
+
     def data(self):
         """ Returns the formated data which is stored in a list holding
         tuples of label to [data]
         """
+        if self.formatedList is None:
+            self.formatedList = zip([str(l) for l in self.labels], self.values.tolist())
+
         return list(self.formatedList)
 
 class FormatJson:
@@ -65,7 +74,7 @@ class FormatJson:
     package and processes it in a way the NaiveBayes classifier can use.
     """
 
-    def __init__(self, trainingFile, samples=1, loadDict=False):
+    def __init__(self, trainingFile, samples=1, loadDict=False, numHarms=0, epsilon=2):
         """ Given a path to a json file, it will do post processing and place
         labelled data in an instance variable for later access.
 
@@ -75,38 +84,109 @@ class FormatJson:
                     This determines the dimensionality of the classifier
             loadDict: if load dict is set to true it treats trainingFile as a python dictionary
             and forgoes loading a json file
+            numHarms, epsilon: the harmonics and the hz around each collected frequency
+            used as features, see harmonicRange
 
         Throws: Exception if file cannot be opened
         """
         self.chans = set()
+        self.samples = samples
+        self.numHarms = numHarms
+        self.epsilon = epsilon
         jData = self.loadJson(trainingFile) if not loadDict else trainingFile
 
         self.freqList = jData["Collected Channels"]
-        self.formatedList = []
+        self.index = numpy.array(self.bins(), dtype=int)
+        self.formatedList = None
+
+        labels = []
+        features = []
 
         # Trial is the trial number and tData is the associated data
         for trial, tData in jData["Data"].items():
+            l, f = self.formatTrial(tData, samples)
+            labels.append(l)
+            features.append(f)
+
+        self.labels = numpy.concatenate(labels) if labels else numpy.array([], dtype=str)
+        self.values = (numpy.concatenate(features) if features else
+                numpy.empty((0, len(self.index) * samples)))
+
+    def formatTrial(self, tData, samples=1):
+        """ Extracts the labelled data of one trial
+
+        Args:
+            tData: the dictionary of channel -> signals of one trial
+            samples: the number of values for each frequency in each label data pair
+
+        Return: (labels, features) where labels is an array of the channel of each row
+        of the (rows, frequencies * samples) features array
+        """
+        labels = []
+        features = []
+
+        # cData holds the data for EMD, Noise and raw FFT
+        for channel, cData in tData.items():
+            self.chans.add(channel)
+
+            # Dictionary of "[0-128] Hz" -> [data]
+            # Choices are "EMD", "EMD Noise" and "Raw FFT"
+            emd = cData["Raw FFT"]
+            frames = len(emd["0"])
+
+            # (frequency, frame) values of the bins of interest. Bins that are missing
+            # frames are padded with nan and their windows dropped
+            rows = [emd[str(f)][0:frames] for f in self.index]
 
-            # cData holds the data for EMD, Noise and raw FFT
-            for channel, cData in tData.items():
-                self.chans.add(channel)
+            if all(len(r) == frames for r in rows):
+                values = numpy.array(rows, dtype=numpy.float64).reshape(len(rows), frames)
+            else:
+                values = numpy.empty((len(rows), frames))
+                values.fill(numpy.nan)
 
-                # Dictionary of "[0-128] Hz" -> [data]
-                # Choices are "EMD", "EMD Noise" and "Raw FFT"
-                emd = cData["Raw FFT"]
-                #labelChannel = int(channel[:-3])
+                for i, r in enumerate(rows):
+                    values[i, 0:len(r)] = r
 
-                # This gives you a list containing indexes separated by samples. If samples = 4
-                # This list could be [0,4,8] for a list of size 12
-                for i in filter(lambda x: x % samples == 0, range(len(emd["0"]) - samples + 1)):
+            merged = self.windows(values, samples)
+            merged = merged[~numpy.isnan(merged).any(axis=1)]
+            labels.extend([channel] * len(merged))
+            features.append(merged)
 
-                    # Makes a list of sample data points * number of frequencies of interest
-                    merge = []
+        if not features:
+            return numpy.array([], dtype=str), numpy.empty((0, len(self.index) * samples))
 
-                    for f in self.harmonicRange(self.freqList, 0, 2):
-                        merge.extend(emd[str(f)][i:i+samples])
+        return numpy.array(labels), numpy.concatenate(features)
 
-                    self.formatedList.append((channel, merge))
+    @classmethod
+    def windows(cls, values, samples):
+        """ Cuts a (..., frequency, frame) array into consecutive windows of samples
+        frames, dropping the frames that do not fill a window
+
+        Return: a (..., windows, frequency * samples) view or copy, each row ordered
+        frequency major and then sample
+        """
+        count = values.shape[-1] // samples
+        shape = values.shape[:-1]
+
+        windows = values[..., 0:count * samples].reshape(shape + (count, samples))
+        windows = windows.swapaxes(-3, -2)
+        return windows.reshape(shape[:-1] + (count, shape[-1] * samples))
+
+    @classmethod
+    def fromFile(cls, trainingFile, samples=1, numHarms=0, epsilon=2, stream=False):
+        """ Opens a training file with the reader matching its format: FormatBinary for
+        *.session files and FormatJson otherwise, or FormatJsonStream if stream is set """
+        if trainingFile.endswith(SessionFile.EXTENSION):
+            return FormatBinary(trainingFile, samples, numHarms, epsilon)
+
+        if stream:
+            return FormatJsonStream(trainingFile, samples, numHarms, epsilon)
+
+        return FormatJson(trainingFile, samples, False, numHarms, epsilon)
+
+    def bins(self):
+        """ Returns the FFT bins the features are taken from """
+        return self.harmonicRange(self.freqList, self.numHarms, self.epsilon)
 
     @classmethod
     def harmonicRange(cls, hzList, numHarms, epsilon):
@@ -126,12 +206,12 @@ class FormatJson:
         array of values representing features of the classifier """
 
         # Makes a list of sample data points * number of frequencies of interest
-        merge = []
+        return numpy.array([freqDict[str(f)][0:samples] for f in self.index]).ravel().tolist()
 
-        for f in self.harmonicRange(self.freqList, 0, 2):
-            merge.extend(freqDict[str(f)][0:samples])
-
-        return merge
+    def formatArray(self, fft, samples=1):
+        """ Same as formatFrequencies but takes a (frequency, frames) array, such as the
+        "Raw FFT" signal of a SignalParser block, instead of a dictionary """
+        return fft[self.index, 0:samples].ravel()
 
     @classmethod
     def loadJson(cls, trainingFile):
@@ -158,8 +238,252 @@ class FormatJson:
         """ Returns the formated data which is stored in a list holding
         tuples of label to [data]
         """
+        if self.formatedList is None:
+            labels, features = self.features()
+            self.formatedList = zip([str(l) for l in labels], features.tolist())
+
         return list(self.formatedList)
 
     def channels(self):
         """ Returns a set of the unique channels """
         return list(self.chans)
+
+    def features(self):
+        """ Return: the formated data as (labels, features) arrays, where labels holds
+        the channel of each row of the (rows, frequencies * samples) features array """
+        return self.labels, self.values
+
+class FormatJsonStream(FormatJson):
+    """ Reads a json training file one trial at a time instead of loading it whole, so
+    memory stays bounded by the largest trial however big the file is. The labelled
+    data is extracted like FormatJson but yielded row by row or in numpy batches.
+    """
+
+    def __init__(self, trainingFile, samples=1, numHarms=0, epsilon=2, batchSize=1024):
+        """ Args:
+            trainingFile: the path to the *.json file
+            samples: the number of values for each frequency in each label data pair
+            numHarms, epsilon: the frequencies used as features, see harmonicRange
+            batchSize: the number of rows in each batch yielded by batches
+
+        Throws: Exception if file cannot be opened
+        """
+        self.trainingFile = trainingFile
+        self.samples = samples
+        self.numHarms = numHarms
+        self.epsilon = epsilon
+        self.batchSize = batchSize
+        self.chans = set()
+        self.freqList = JsonTrialStream.collectedChannels(trainingFile)
+        self.index = numpy.array(self.bins(), dtype=int)
+
+    def trials(self):
+        """ Yields (trial, tData) for every trial in the file """
+        return JsonTrialStream(self.trainingFile).trials()
+
+    def rows(self):
+        """ Yields the (channel, [data]) tuples of the file, parsing a trial at a time """
+        for labels, features in self.batches():
+            for row in zip([str(l) for l in labels], features.tolist()):
+                yield row
+
+    def batches(self):
+        """ Yields (labels, features) with batchSize rows each, the last one possibly
+        fewer, where labels is an array of the channel of each row of the
+        (rows, frequencies * samples) features array """
+        labels = []
+        features = []
+        count = 0
+
+        for trial, tData in self.trials():
+            l, f = self.formatTrial(tData, self.samples)
+            labels.append(l)
+            features.append(f)
+            count += len(l)
+
+            while count >= self.batchSize:
+                l = numpy.concatenate(labels)
+                f = numpy.concatenate(features)
+                yield l[:self.batchSize], f[:self.batchSize]
+
+                labels = [l[self.batchSize:]]
+                features = [f[self.batchSize:]]
+                count -= self.batchSize
+
+        if count:
+            yield numpy.concatenate(labels), numpy.concatenate(features)
+
+    def data(self):
+        """ Returns the formated data which is stored in a list holding
+        tuples of label to [data]. This holds every row in memory, use rows or batches
+        to keep memory bounded
+        """
+        return list(self.rows())
+
+    def features(self):
+        """ Same as FormatJson.features, reading the file a trial at a time """
+        batches = list(self.batches())
+        width = len(self.index) * self.samples
+
+        if not batches:
+            return numpy.array([], dtype=str), numpy.empty((0, width))
+
+        return (numpy.concatenate([labels for labels, features in batches]),
+                numpy.concatenate([features for labels, features in batches]))
+
+    def channels(self):
+        """ Returns a set of the unique channels """
+        if not self.chans:
+            for trial, tData in self.trials():
+                self.chans.update(tData.keys())
+
+        return list(self.chans)
+
+class JsonTrialStream():
+    """ Incrementally parses the "Data" dictionary of a json training file, decoding a
+    single trial at a time out of a buffer that is refilled from the file as needed """
+    collected = re.compile(r'"Collected Channels"\s*:\s*(\[[^\]]*\])')
+
+    def __init__(self, trainingFile, chunkSize=1 << 20):
+        try:
+            self.file = open(trainingFile, "r")
+        except IOError as e:
+            raise Exception("Couldn't open file", e)
+
+        self.chunkSize = chunkSize
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+
+    @classmethod
+    def collectedChannels(cls, trainingFile, edge=1 << 16):
+        """ Finds the "Collected Channels" list, which is written either before or after
+        all of the trials, by looking at the start and end of the file only """
+        try:
+            with open(trainingFile, "r") as f:
+                head = f.read(edge)
+                f.seek(0, 2)
+                f.seek(max(0, f.tell() - edge))
+                tail = f.read()
+        except IOError as e:
+            raise Exception("Couldn't open file", e)
+
+        for text in (head, tail):
+            match = cls.collected.search(text)
+            if match:
+                return json.loads(match.group(1))
+
+        raise Exception("Couldnt parse json file!", "No Collected Channels")
+
+    def more(self):
+        """ Appends the next chunk of the file to the unparsed part of the buffer """
+        chunk = self.file.read(self.chunkSize)
+        if not chunk:
+            raise Exception("Couldnt parse json file!", "Unexpected end of file")
+
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def skip(self, characters=" \t\r\n"):
+        """ Moves past any of characters and returns the next character """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in characters:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            self.more()
+
+    def decode(self):
+        """ Decodes the json value at the current position, reading until it is whole """
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                self.position = end
+                return value
+            except ValueError:
+                self.more()
+
+    def trials(self):
+        """ Yields (trial, tData) for every trial in the file """
+        try:
+            # Both top level keys are short, so the buffer only needs to keep enough of
+            # the previous chunk to match "Data" across the chunk boundary
+            while self.buffer.find('"Data"') == -1:
+                self.more()
+                self.position = max(0, len(self.buffer) - 5)
+
+            self.position = self.buffer.find('"Data"') + len('"Data"')
+            self.skip(" \t\r\n:")
+            self.position += 1 # {
+
+            while self.skip(" \t\r\n,") != "}":
+                trial = self.decode()
+                self.skip(" \t\r\n:")
+                yield trial, self.decode()
+        finally:
+            self.file.close()
+
+class FormatBinary(FormatJson):
+    """ Reads a training session in the binary format of SessionFile. The values are
+    memory mapped and the features are only extracted the first time they are asked
+    for, which gives the same data as FormatJson gives for the same session.
+    """
+
+    def __init__(self, trainingFile, samples=1, numHarms=0, epsilon=2):
+        """ Args:
+            trainingFile: the path to the *.session file
+            samples: the number of values for each frequency in each label data pair
+            numHarms, epsilon: the frequencies used as features, see harmonicRange
+
+        Throws: Exception if file cannot be opened
+        """
+        self.session = SessionFile(trainingFile)
+        self.samples = samples
+        self.numHarms = numHarms
+        self.epsilon = epsilon
+        self.freqList = self.session.freqList
+        self.index = numpy.array(self.bins(), dtype=int)
+        self.chans = set(self.session.targets)
+        self.formatedList = None
+
+    def features(self):
+        """ Extracts the features of every window of samples frames in the session
+
+        Return: (labels, features) where labels is an array of the target of each row
+        of the (rows, frequencies * samples) features array
+        """
+        values = self.session.values
+        trials, targets, _, frames = values.shape
+
+        # Only the bins of interest are read from the file
+        windows = self.windows(values[:, :, self.index].astype(numpy.float64), self.samples)
+        count = windows.shape[2]
+        windows = windows.reshape(trials * targets * count, -1)
+        labels = numpy.tile(numpy.repeat(self.session.targets, count), trials)
+
+        # Frames past the end of a shorter trial are nan
+        complete = ~numpy.isnan(windows).any(axis=1)
+        return labels[complete], windows[complete]
+
+class FormatArrays(FormatJson):
+    """ Holds features that were already extracted, such as the ones kept by
+    FeatureCache, behind the FormatJson API """
+
+    def __init__(self, labels, features, freqList, samples=1, numHarms=0, epsilon=2):
+        """ Args:
+            labels: an array of the channel of each row of features
+            features: a (rows, frequencies * samples) array
+            freqList: the list of frequencies collected on
+            samples, numHarms, epsilon: the parameters the features were extracted with
+        """
+        self.labels = labels
+        self.values = features
+        self.freqList = list(freqList)
+        self.samples = samples
+        self.numHarms = numHarms
+        self.epsilon = epsilon
+        self.index = numpy.array(self.bins(), dtype=int)
+        self.chans = set(str(l) for l in labels)
+        self.formatedList = None
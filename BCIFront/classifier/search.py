@@ -0,0 +1,216 @@
+""" Searches the feature extraction parameters, samples and the numHarms and epsilon of
+FormatJson.harmonicRange, together with the predictThreshold of NaiveBayes, for the
+most accurate combination on a training session.
+
+The session is parsed once into the binary session format. Every combination of
+extraction parameters has its features extracted once, from the memory mapped session,
+and is cross validated in a pool of processes. Every threshold is scored from the same
+cross validated predictions, as the accuracy of the rows predicted with at least that
+probability. Run from the repository root:
+
+    python -m BCIFront.classifier.search session.json [--samples 1 2 3]
+        [--harmonics 0 1 2] [--epsilon 1 2 3] [--thresholds 0 .9 .95] [--patience 8]
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import itertools
+import numpy
+from timeit import default_timer as timer
+from multiprocessing import Pool, cpu_count
+from naive import NaiveBayes
+from naiveFormats import FormatJson, FormatBinary
+from sessionFile import SessionFile
+
+class ParameterSearch():
+    """ A grid search over the parameters features are extracted with and the
+    threshold predictions are accepted at """
+
+    def __init__(self, trainingFile, K=10, processes=None, repeats=200):
+        """ Args:
+            trainingFile: a json or binary training session
+            K: the number of cross validation folds
+            processes: the size of the worker pool, defaults to the number of cpus
+            repeats: the number of single row predictions timed for the latency
+
+        Throws: Exception if the session cannot be opened
+        """
+        self.K = K
+        self.processes = processes or cpu_count()
+        self.repeats = repeats
+        self.directory = None
+
+        if trainingFile.endswith(SessionFile.EXTENSION):
+            self.path = trainingFile
+        else:
+            self.directory = tempfile.mkdtemp()
+            self.path = os.path.join(self.directory, "search" + SessionFile.EXTENSION)
+            SessionFile.fromJson(trainingFile, self.path)
+
+        # Only the header is kept, the memory map of the values would stop close
+        # removing a converted session on Windows
+        session = SessionFile(self.path)
+        self.freqList = session.freqList
+        self.bins = session.bins
+        del session
+
+    def close(self):
+        """ Removes the session converted from json, if there is one """
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def features(self, samples, numHarms, epsilon):
+        """ Return: the number of features extracted with these parameters, or 0 if they
+        select no bins or bins past the end of the session """
+        bins = FormatJson.harmonicRange(self.freqList, numHarms, epsilon)
+
+        if not bins or min(bins) < 0 or max(bins) >= self.bins:
+            return 0
+
+        return len(bins) * samples
+
+    def grid(self, samples, harmonics, epsilons):
+        """ Return: every usable (samples, numHarms, epsilon) combination, the ones with
+        the fewest features first """
+        grid = [p for p in itertools.product(samples, harmonics, epsilons)
+                if self.features(*p)]
+
+        return sorted(grid, key=lambda p: (self.features(*p), p))
+
+    def run(self, samples=(1, 2, 3), harmonics=(0, 1, 2), epsilons=(1, 2, 3),
+            thresholds=(0, .9, .95), patience=None, minCoverage=0.5):
+        """ Evaluates the grid
+
+        Args:
+            samples, harmonics, epsilons: the values of samples, numHarms and epsilon
+            thresholds: the values of predictThreshold
+            patience: if set, stop after this many combinations in a row finish without
+            improving on the best accuracy
+            minCoverage: the least fraction of rows a threshold must accept for its
+            accuracy to count as an improvement and to be ranked with the others
+
+        Return: a list of result dictionaries, see evaluate, best first
+        """
+        tasks = [(self.path, p, self.K, thresholds, self.repeats)
+                for p in self.grid(samples, harmonics, epsilons)]
+        results = []
+        best = None
+        stale = 0
+
+        pool = Pool(self.processes)
+        try:
+            # In the order of the grid, so where patience stops does not depend on which
+            # worker finishes first
+            for found in pool.imap(evaluate, tasks):
+                results.extend(found)
+                accuracy = max([r["accuracy"] for r in found if r["coverage"] >= minCoverage]
+                        + [0])
+
+                if best is None or accuracy > best:
+                    best = accuracy
+                    stale = 0
+                else:
+                    stale += 1
+
+                if patience is not None and stale >= patience:
+                    print "Stopping early after", len(results) / len(thresholds), "of", \
+                            len(tasks), "combinations"
+                    pool.terminate()
+                    break
+            else:
+                pool.close()
+        finally:
+            pool.join()
+
+        return ParameterSearch.rank(results, minCoverage)
+
+    @classmethod
+    def rank(cls, results, minCoverage=0.5):
+        """ Return: the results ordered by accuracy, then fewer features, then higher
+        coverage. Results accepting less than minCoverage of the rows come last. Ties
+        are ordered by the parameters rather than the latency, which varies from run to
+        run, so the same search always ranks the same way """
+        return sorted(results, key=lambda r: (r["coverage"] < minCoverage, -r["accuracy"],
+                r["features"], -r["coverage"], r["samples"], r["numHarms"], r["epsilon"],
+                r["threshold"]))
+
+    @classmethod
+    def table(cls, results):
+        """ Return: the results as a printable table """
+        lines = ["%4s %7s %8s %7s %9s %9s %9s %12s" % ("rank", "samples", "numHarms",
+                "epsilon", "threshold", "accuracy", "coverage", "latency (ms)")]
+
+        for i, r in enumerate(results):
+            lines.append("%4d %7d %8d %7d %9.2f %8.2f%% %8.1f%% %12.4f   %d features" % (
+                    i + 1, r["samples"], r["numHarms"], r["epsilon"], r["threshold"],
+                    r["accuracy"], r["coverage"] * 100, r["latency"], r["features"]))
+
+        return "\n".join(lines)
+
+def evaluate(task):
+    """ Extracts the features of one combination of parameters, cross validates them
+    and scores every threshold. A function so a process pool can run it
+
+    Args:
+        task: (session path, (samples, numHarms, epsilon), K, thresholds, repeats)
+
+    Return: a list with a dictionary for every threshold of the samples, numHarms,
+    epsilon, threshold, accuracy in percent of the rows predicted with at least the
+    threshold's probability, coverage as the fraction of those rows, features, rows
+    and the ms latency of a single row predict
+    """
+    path, (samples, numHarms, epsilon), K, thresholds, repeats = task
+
+    labels, features = FormatBinary(path, samples, numHarms, epsilon).features()
+    classy = NaiveBayes(features, labels)
+
+    # The pool's workers cannot start pools of their own
+    predicted, confidence = classy.crossPredict(K, processes=1)
+    correct = predicted == classy.trainingLabels
+
+    rows = classy.trainingFeatures[0:repeats]
+    start = timer()
+    for row in rows:
+        classy.predict(row)
+    latency = (timer() - start) / max(len(rows), 1) * 1000
+
+    results = []
+
+    for threshold in thresholds:
+        accepted = confidence >= threshold
+        accuracy = correct[accepted].mean() * 100 if accepted.any() else 0.0
+
+        results.append({"samples": samples, "numHarms": numHarms, "epsilon": epsilon,
+                "threshold": threshold, "accuracy": float(accuracy),
+                "coverage": float(accepted.mean()), "features": features.shape[1],
+                "rows": len(features), "latency": latency})
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Search feature extraction parameters")
+    parser.add_argument("session", help="a json or binary training session")
+    parser.add_argument("--samples", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--harmonics", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--epsilon", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0, .9, .95])
+    parser.add_argument("--folds", type=int, default=10)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--patience", type=int,
+            help="stop after this many combinations without improvement")
+    parser.add_argument("--coverage", type=float, default=0.5,
+            help="the least fraction of rows a threshold must accept to be ranked")
+    parser.add_argument("--top", type=int, help="only print the best results")
+    args = parser.parse_args()
+
+    search = ParameterSearch(args.session, args.folds, args.processes)
+    try:
+        results = search.run(args.samples, args.harmonics, args.epsilon, args.thresholds,
+                args.patience, args.coverage)
+    finally:
+        search.close()
+
+    print ParameterSearch.table(results[0:args.top])
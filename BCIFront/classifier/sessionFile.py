@@ -0,0 +1,235 @@
+""" A compact binary format for training sessions. The "Raw FFT" values of a session
+are kept as one dense float32 array of shape (trial, target, bin, frame) that is memory
+mapped on load, so nothing is parsed and only the pages that are used are read.
+
+The file starts with a fixed size header: a magic string and a json dictionary of the
+metadata, padded with spaces. The array follows in C order, one trial after the other,
+so trials can be appended while recording. Run from the repository root to convert:
+
+    python -m BCIFront.classifier.sessionFile session.json session.session
+    python -m BCIFront.classifier.sessionFile session.session session.json
+"""
+import os
+import sys
+import json
+import numpy
+from datetime import datetime
+
+class SessionFile():
+    """ A training session stored in the binary session format """
+    MAGIC = "BCISESS1"
+    HEADER_SIZE = 4096
+    DTYPE = numpy.dtype("<f4")
+    EXTENSION = ".session"
+
+    def __init__(self, path):
+        """ Reads the header of a session file and maps its values. Nothing else is
+        read until the values are used
+
+        Args:
+            path: the path to the *.session file
+
+        Throws: Exception if the file cannot be opened or is not a session file
+        """
+        self.path = path
+        self.header = SessionFile.readHeader(path)
+
+        self.targets = self.header["targets"]
+        self.freqList = self.header["Collected Channels"]
+        self.bins = self.header["bins"]
+        self.frames = self.header["frames"]
+        self.trials = self.header["trials"]
+        self.subject = self.header.get("subject")
+        self.date = self.header.get("date")
+        self.values = self.mapValues()
+
+    @classmethod
+    def readHeader(cls, path):
+        """ Return: the metadata dictionary of the session file at path """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(cls.HEADER_SIZE)
+        except IOError as e:
+            raise Exception("Couldn't open file", e)
+
+        if not header.startswith(cls.MAGIC):
+            raise Exception("Not a session file: " + str(path))
+
+        try:
+            return json.loads(header[len(cls.MAGIC):])
+        except ValueError as e:
+            raise Exception("Couldnt parse session header!", e)
+
+    @classmethod
+    def writeHeader(cls, f, metadata):
+        """ Writes the header at the start of an open file, leaving the file position
+        where it was """
+        text = cls.MAGIC + json.dumps(metadata)
+
+        if len(text) >= cls.HEADER_SIZE:
+            raise Exception("Session metadata does not fit in the header")
+
+        position = f.tell()
+        f.seek(0)
+        f.write(text + " " * (cls.HEADER_SIZE - len(text) - 1) + "\n")
+        f.seek(max(position, cls.HEADER_SIZE))
+
+    @classmethod
+    def metadata(cls, targets, freqList, bins, frames, trials=0, subject=None, date=None):
+        """ Return: the header dictionary. date is an ISO 8601 string, defaulting to now """
+        return {"targets": list(targets), "Collected Channels": list(freqList),
+                "bins": bins, "frames": frames, "trials": trials,
+                "subject": subject, "date": date or datetime.now().isoformat(),
+                "signal": "Raw FFT", "dtype": cls.DTYPE.str}
+
+    def mapValues(self):
+        """ Return: a read only (trial, target, bin, frame) memory map of the values """
+        shape = (self.trials, len(self.targets), self.bins, self.frames)
+
+        if not self.trials:
+            return numpy.empty(shape, dtype=SessionFile.DTYPE)
+
+        return numpy.memmap(self.path, dtype=SessionFile.DTYPE, mode="r",
+                offset=SessionFile.HEADER_SIZE, shape=shape)
+
+    def trial(self, trial, target):
+        """ Return: the (bin, frame) values of one target of one trial. Frames that
+        were not recorded are nan """
+        return self.values[trial, self.targets.index(target)]
+
+    @classmethod
+    def save(cls, path, values, targets, freqList, subject=None, date=None):
+        """ Writes a whole session
+
+        Args:
+            path: the file to write
+            values: a (trial, target, bin, frame) array
+            targets: the names of the targets, in the order of the target axis
+            freqList: the list of frequencies collected on
+            subject, date: kept in the header, see metadata
+        """
+        values = numpy.asarray(values, dtype=cls.DTYPE)
+        trials, _, bins, frames = values.shape
+
+        with open(path, "wb") as f:
+            cls.writeHeader(f, cls.metadata(targets, freqList, bins, frames, trials,
+                    subject, date))
+            f.write(values.tostring())
+
+    @classmethod
+    def fromDict(cls, js, path, subject=None, date=None):
+        """ Converts a training dictionary, as returned by bciComms.processTrainData or
+        loaded from its json file, into a session file. Bins and frames missing from a
+        trial are stored as nan """
+        data = js["Data"]
+        trials = sorted(data.keys(), key=int)
+        targets = sorted(set(c for t in trials for c in data[t].keys()))
+
+        bins = 0
+        frames = 0
+        for t in trials:
+            for fft in [c["Raw FFT"] for c in data[t].values()]:
+                bins = max([bins] + [int(b) + 1 for b in fft.keys()])
+                frames = max([frames] + [len(v) for v in fft.values()])
+
+        values = numpy.empty((len(trials), len(targets), bins, frames), dtype=cls.DTYPE)
+        values.fill(numpy.nan)
+
+        for i, t in enumerate(trials):
+            for channel, cData in data[t].items():
+                for b, v in cData["Raw FFT"].items():
+                    values[i, targets.index(channel), int(b), 0:len(v)] = v
+
+        cls.save(path, values, targets, js["Collected Channels"], subject, date)
+        return cls(path)
+
+    @classmethod
+    def fromJson(cls, jsonPath, path, subject=None):
+        """ Converts a json training file into a session file, dated by when the json
+        file was last written """
+        date = datetime.fromtimestamp(os.path.getmtime(jsonPath)).isoformat()
+
+        with open(jsonPath, "r") as f:
+            return cls.fromDict(json.load(f), path, subject, date)
+
+    def toDict(self):
+        """ Return: the session as the dictionary written by bciComms.processTrainData """
+        data = {}
+
+        for t in range(self.trials):
+            data[str(t)] = {}
+
+            for g, target in enumerate(self.targets):
+                fft = {}
+
+                for b, row in enumerate(self.values[t, g]):
+                    row = row[~numpy.isnan(row)]
+                    if len(row):
+                        fft[str(b)] = row.tolist()
+
+                data[str(t)][target] = {"Raw FFT": fft}
+
+        return {"Data": data, "Collected Channels": self.freqList}
+
+    def toJson(self, jsonPath):
+        """ Writes the session as a json training file """
+        with open(jsonPath, "w") as f:
+            json.dump(self.toDict(), f, indent=4, separators=(',', ': '))
+
+class SessionWriter():
+    """ Writes a session file trial by trial while it is being recorded. Every trial
+    is on disk, and the header counts it, as soon as append returns, so nothing is kept
+    in memory and the file is complete the moment the last trial is appended.
+    """
+
+    def __init__(self, path, targets, freqList, bins, frames, subject=None):
+        """ Args:
+            path: the file to write
+            targets: the names of the targets recorded in every trial
+            freqList: the list of frequencies collected on
+            bins: the number of FFT bins in a frame
+            frames: the number of frames kept for each target of a trial
+            subject: who the session is recorded from, kept in the header
+        """
+        self.path = path
+        self.targets = sorted(targets)
+        self.metadata = SessionFile.metadata(self.targets, freqList, bins, frames,
+                subject=subject)
+        self.file = open(path, "wb")
+        SessionFile.writeHeader(self.file, self.metadata)
+
+    def append(self, trial):
+        """ Writes one trial
+
+        Args:
+            trial: a dictionary of target name to its (bin, frame) values. Missing
+            bins or frames are stored as nan and extra ones are dropped
+        """
+        values = numpy.empty((len(self.targets), self.metadata["bins"],
+                self.metadata["frames"]), dtype=SessionFile.DTYPE)
+        values.fill(numpy.nan)
+
+        for target, fft in trial.items():
+            fft = fft[0:values.shape[1], 0:values.shape[2]]
+            values[self.targets.index(target), 0:fft.shape[0], 0:fft.shape[1]] = fft
+
+        self.file.write(values.tostring())
+        self.metadata["trials"] += 1
+        SessionFile.writeHeader(self.file, self.metadata)
+        self.file.flush()
+
+    def close(self):
+        """ Closes the file and returns it opened as a SessionFile """
+        self.file.close()
+        return SessionFile(self.path)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: sessionFile.py input.json output.session | input.session output.json"
+        sys.exit(1)
+
+    if sys.argv[1].endswith(SessionFile.EXTENSION):
+        SessionFile(sys.argv[1]).toJson(sys.argv[2])
+    else:
+        session = SessionFile.fromJson(sys.argv[1], sys.argv[2])
+        print "Wrote", session.trials, "trials of", session.targets
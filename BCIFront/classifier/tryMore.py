@@ -7,7 +7,7 @@ from sklearn.lda import LDA
 from sklearn.qda import QDA
 from sklearn.cross_validation import train_test_split
 import numpy as np
-from naiveFormats import FormatJson
+from featureCache import FeatureCache
 import sys
 
 names = ["Nearest Neighbors", "Linear SVM", "RBF SVM", "Decision Tree",
@@ -24,7 +24,7 @@ classifiers = [
     LDA(),
     QDA()]
 
-formater = FormatJson(sys.argv[1])
+formater = FeatureCache().load(sys.argv[1])
 data = formater.data()
 
 x = []
@@ -1,15 +1,21 @@
 import sys, os
 import json
+import shutil
 import socket
 from PySide import QtGui, QtCore
 from BCIFront.classifier.naiveFormats import FormatJson
+from BCIFront.classifier.sessionFile import SessionFile, SessionWriter
+from BCIFront.classifier.featureCache import FeatureCache
 from BCIFront.classifier.naive import NaiveBayes
 from BCIFront.gui.bciHelper import bciComms
+from BCIFront.gui.bciRing import FrameRing, RingReader, SlidingWindow
+from BCIFront.gui.rawArchive import RawArchive, RawStreamWriter, StreamControl
 from math import sin, cos, radians
+from time import time as currentTime
 from Queue import Queue
 import random
-from multiprocessing import Process, Value, Pipe, Queue as multiQueue
-import ctypes
+import numpy
+from multiprocessing import Process
 import winsound
 
 class BciMain(QtGui.QMainWindow):
@@ -20,6 +26,9 @@ class BciMain(QtGui.QMainWindow):
         self.trainingDataFormater = None
         # Default values
         self.settings = {"port": 7337, "numTrials": 10, "trialLength": 10,
+                "lookbackSeconds": 128, "maxFrameValues": 2048,
+                "windowFrames": 1, "hopFrames": 1, "forgetting": 1.0,
+                "subscription": {"signals": [0, 0], "states": ["SourceTime"]},
                 "channels": {},
                 "freqMap": {
                     "15 Hz": {"x": 200, "y": 900, "theta": 270},
@@ -33,6 +42,7 @@ class BciMain(QtGui.QMainWindow):
                 }
         self.directory = os.path.dirname(os.path.realpath(__file__))
         self.settingsFile = os.path.join(self.directory, "config.json")
+        self.schemaFile = os.path.join(self.directory, "schema.json")
         super(BciMain, self).__init__()
 
         # Read in settings file ("config.json")
@@ -45,18 +55,21 @@ class BciMain(QtGui.QMainWindow):
         # starting a training session
         self.initialPrompt()
 
-        # Networking to BCI
-        self.sendPacket = Value(ctypes.c_bool, False, lock=False)
-        self.pipeReceive, self.pipeSend = Pipe(True)
-        self.proc = Process(target=bciComms.bciConnection, args=(self.IP, int(self.settings["port"]), self.sendPacket, self.pipeSend))
+        # Networking to BCI. The acquisition process parses the frames and shares
+        # them with every consumer through the ring, which always holds the last
+        # lookbackSeconds of frames. BCI2000 sends a frame every half a second
+        subscription = self.settings.get("subscription") or {}
+        self.ring = FrameRing(int(self.settings.get("lookbackSeconds", 128) / .5),
+                int(self.settings.get("maxFrameValues", 2048)), subscription.get("states", []))
+        ports = self.settings.get("ports") or [int(self.settings["port"])]
+
+        # The streams are only archived while the training screen records
+        self.streamControl = StreamControl()
+        self.proc = Process(target=bciComms.bciConnection, args=(self.IP, ports, self.ring,
+                self.settings.get("subscription"), self.schemaFile, self.directory,
+                self.streamControl))
         self.proc.start()
 
-        self.headerRegex = r"SourceTime[\s]+([0-9]+)"
-        self.sendPacket.value = True
-        self.endPacketRegex = bciComms.determineEndRegex(self.pipeReceive)
-        print self.endPacketRegex
-        self.sendPacket.value = False
-
         # Set size and title
         self.setGeometry(300, 300, 640, 480)
         self.center()
@@ -71,15 +84,33 @@ class BciMain(QtGui.QMainWindow):
         if self.proc.is_alive():
             self.proc.terminate()
 
-    def writeFile(self, data, trial, channel):
-        f = open("temp/"+str(trial)+str(channel)+".txt", 'w')
+    def newReader(self, since=None):
+        """ Returns a RingReader for the frames of the configured source, or of every
+        source if none is set
+
+        Args:
+            since: a time.time() value. If set the reader starts at the first frame that
+            arrived after it, otherwise at the next frame
+        """
+        reader = RingReader(self.ring, source=self.settings.get("source"))
 
-        for d in data:
-            f.write(d)
+        if since is not None:
+            reader.seek(since)
+
+        return reader
+
+    def newWindow(self):
+        """ Returns a SlidingWindow over a new reader, sized by the windowFrames and
+        hopFrames settings, for the run screens to classify from """
+        return SlidingWindow(self.newReader(), self.settings.get("windowFrames", 1),
+                self.settings.get("hopFrames", 1))
 
     def trainingScreen(self):
         """ Displays a training screen that displays arrows to different frequency lights
-        and records the data within each of these periods. Saves this data in a JSON file """
+        and records the data within each of these periods. Every trial is appended to a
+        session file as soon as it is recorded, which is then saved where the user picks.
+        The lines of the trials, as they were received, are kept in a RawArchive saved
+        next to it """
         window = drawWidget(self)
 
         # Creates a random ordering of the trials
@@ -87,71 +118,135 @@ class BciMain(QtGui.QMainWindow):
                     if not i == "None"]
         trials = self.settings["numTrials"]
         time = self.settings["trialLength"]
-        bciData = {}
+        frames = int(time / .5)
+
+        # List of frequencies collected on
+        freqList = [int(x.split(" ")[0]) for x in channels]
+        freqList.sort()
+
+        recording = os.path.join(self.directory, "recording" + SessionFile.EXTENSION)
+        writer = None
+        archive = RawArchive(os.path.join(self.directory, "recording"))
+        archive.clear()
+
+        # (trial, target, source, SourceTime and arrival of the frames) of every target
+        spans = []
+        self.streamControl.start()
 
         for t in range(trials):
             print (t+1), "/", trials
             random.shuffle(channels)
-            bciData[t] = {}
+            trial = {}
 
             for c in channels:
                 # Setup
                 param = self.settings["freqMap"][c]
-                q = multiQueue()
 
                 window.drawCrossTimed(0.4, 3, True)
 
-                # Starting storing packets sent through the pipe when a
-                # batch arriving from BCI2000 completes. This is signalled
-                # by the last Signal(X,Y) received.
-                self.sendPacket.value = True
-                lastStamp = bciComms.discardTill(self.pipeReceive, self.endPacketRegex, self.headerRegex)
-                lastStamp = int(lastStamp)
+                # The trial's frames are taken out of the ring from the moment the
+                # arrow is shown. BCI2000 sends a frame every half a second
+                onset = currentTime()
+                window.drawArrowTimed(param["x"], param["y"], 200, param["theta"], time, True)
 
-                collectProc = Process(target=bciComms.collectData,
-                        args=(self.pipeReceive, time, self.headerRegex, self.endPacketRegex, q, lastStamp))
-                collectProc.start()
+                reader = self.newReader(since=onset)
+                rows = reader.wait(frames)
+                trial[c] = self.ring.block(rows)[0].copy()
+                spans.append((t, c, rows[:, [FrameRing.SOURCE, FrameRing.STAMP,
+                        FrameRing.ARRIVAL]].copy()))
 
-                window.drawArrowTimed(param["x"], param["y"], 200, param["theta"], time, True)
+            # The number of bins is only known once frames have arrived
+            if writer is None:
+                writer = SessionWriter(recording, channels, freqList, self.ring.schema()[1],
+                        frames, self.settings.get("subject"))
 
-                bciData[t][c] = q.get()
+            writer.append(trial)
 
-                self.writeFile(bciData[t][c], t, c)
-                self.sendPacket.value = False
+        # The acquisition process writes the frames received until now as soon as the
+        # next one starts, instead of when they have waited flushSeconds
+        self.streamControl.stop(currentTime())
 
-        # Write the training data to a file, and get the formated training data
-        fName, _ = QtGui.QFileDialog.getSaveFileName(self, "Save the test data", "", "JSON (*.json)", "JSON (*.json)")
+        if writer is None:
+            self.showMessage("No trials were recorded")
+            window.close()
+            return
+
+        # Not opened as a SessionFile, whose memory map would stop the file being moved
+        writer.close()
+        self.archiveTrials(archive, spans)
+
+        # Move the recording to where the user wants it
+        fName, _ = QtGui.QFileDialog.getSaveFileName(self, "Save the test data", "",
+                "Session (*.session);;JSON (*.json)")
 
         # User didn't pick a filename, ask them again and if repeated return
         if fName == "":
-            self.showMessage("You didn't select a file! Try again otherwise data is lost")
-            fName, _ = QtGui.QFileDialog.getSaveFileName(self, "Save the test data", "", "JSON (*.json)", "JSON (*.json)")
+            self.showMessage("You didn't select a file! Try again otherwise the recording is not kept")
+            fName, _ = QtGui.QFileDialog.getSaveFileName(self, "Save the test data", "",
+                    "Session (*.session);;JSON (*.json)")
 
             if fName == "":
+                self.showMessage("The recording is left in " + recording + " and " +
+                        archive.path + RawArchive.DATA)
                 window.close()
                 return
 
-        formatedJson = None
+        if fName.endswith(".json"):
+            SessionFile(recording).toJson(fName)
+        else:
+            if not fName.endswith(SessionFile.EXTENSION):
+                fName += SessionFile.EXTENSION
 
-        # List of frequencies collected on
-        freqList = [int(x.split(" ")[0]) for x in channels]
-        freqList.sort()
+            shutil.move(recording, fName)
 
-        with open(fName, "w") as f:
-            formatedJson = bciComms.processTrainData(bciData, freqList, f)
+        archive.move(os.path.splitext(fName)[0])
 
         # Saves the training data to the instance field, trains the classifier and transitions to run screen
-        self.trainingDataFormater = FormatJson(formatedJson, loadDict=True)
+        self.trainingDataFormater = FormatJson.fromFile(fName)
         if self.trainClassifier():
             self.transitionToRun()
 
         window.close()
 
+    def archiveTrials(self, archive, spans):
+        """ Copies the lines of every trial, exactly as the acquisition process received
+        them, out of its stream archives into the archive of the recording
+
+        Args:
+            archive: the RawArchive of the recording
+            spans: a list of (trial, target, rows) where every row holds the source,
+            SourceTime and arrival of one of the trial's frames
+        """
+        streams = {}
+
+        # A frame reaches the ring when its last line arrives, and the stream archive
+        # when the next frame starts
+        slack = 1.0
+        timeout = 2.0
+
+        # The last frames of every source may not be written yet
+        for source in numpy.unique(numpy.concatenate([r[:, 0] for _, _, r in spans])):
+            last = numpy.concatenate([r[r[:, 0] == source] for _, _, r in spans])[-1]
+            streams[int(source)] = RawArchive(RawStreamWriter.streamPath(self.directory,
+                    int(source)))
+
+            if not streams[int(source)].waitFor(int(last[1]), (last[2] - slack,
+                    last[2] + slack), timeout):
+                print "The stream of source", int(source), "is not archived"
+
+        for t, c, rows in spans:
+            for source in numpy.unique(rows[:, 0]).astype(int):
+                frames = rows[rows[:, 0] == source]
+                archive.append(streams[source].lines(since=int(frames[0, 1]),
+                        until=int(frames[-1, 1]), received=(frames[0, 2] - slack,
+                        frames[-1, 2] + slack)), t, c)
+
     def trainClassifier(self):
         """ Trains the classifier. If any error occurs, it prints the exception.
         Returns true if training was successful and false otherwise """
         try:
-            self.classifier = NaiveBayes(self.trainingDataFormater.data())
+            labels, features = self.trainingDataFormater.features()
+            self.classifier = NaiveBayes(features, labels)
             return True
         except Exception as e:
             BciMain.showMessage("Could not train classifier. Error:\n" + str(e))
@@ -307,7 +402,7 @@ class BciMain(QtGui.QMainWindow):
     # of [("label", [data])] to an instance variable
     def loadFile(self):
         """ Prompts the user for a training file and if it is appropriately formated,
-        trains the classifier. Supports both old matlab format and the json format
+        trains the classifier. Supports the json and binary session formats
         generated by this program
         """
         fname, _ = QtGui.QFileDialog.getOpenFileName(self, 'Open file')
@@ -317,7 +412,7 @@ class BciMain(QtGui.QMainWindow):
             return
 
         try:
-            formater = FormatJson(fname)
+            formater = FeatureCache().load(fname)
             self.trainingDataFormater = formater
 
             if self.trainClassifier():
@@ -381,7 +476,6 @@ class robotControlRunScreen():
         winsound.PlaySound("ding.wav", winsound.SND_FILENAME)
             
     def closeEvent(self, event):
-        self.parent.sendPacket.value = False
         if self.helper.isRunning():
             self.helper.terminate()
 
@@ -395,28 +489,26 @@ class robotControlRunScreenHelper(QtCore.QThread):
         self.coms = coms
 
         self.timeout = 3 # seconds till it forces a classification
-        self.period = 0.5 # the time between bci2000 headers
+        self.period = 0.5 * parent.settings.get("hopFrames", 1) # the time between decisions
         self.threshold = 0.95 # The confidence when to display the classification
 
     def run(self):
         count = 0
         previous = {} # Used to keep track of previous predictions
-        self.parent.sendPacket.value = True
-        q = multiQueue()
-        last = bciComms.discardTill(self.parent.pipeReceive, self.parent.endPacketRegex, self.parent.headerRegex)
-        last = int(last)
+        window = self.parent.newWindow()
 
         collecting = True
 
         while True:
             count += 1
-            last = bciComms.collectData(self.parent.pipeReceive, self.period, self.parent.headerRegex,
-                    self.parent.endPacketRegex, q, last)
-            data = q.get()
+            window.next()
+
+            if window.behind():
+                print "Falling behind by " + str(window.backlog) + " frames"
 
-            # Takes the raw data and decomposes it into a dict of the corresponding terms
-            processed = bciComms.rawToDict(data)
-            classWith = self.parent.trainingDataFormater.formatFrequencies(processed["Raw FFT"])
+            # The (signal, channel, 1) average of the frames in the window
+            processed = window.average()
+            classWith = self.parent.trainingDataFormater.formatArray(processed[0])
 
             prediction = None
             accuracy = None
@@ -453,6 +545,9 @@ class robotControlRunScreenHelper(QtCore.QThread):
                 count = 0
                 self.coms.txt.emit("")
 
+                # Frames from while the robot was moving are not classified
+                window.clear()
+
 class drawWidget(QtGui.QMainWindow):
 
     def __init__(self, parent):
@@ -1,87 +1,38 @@
 import socket
 import re
 import json
+import numpy
+from time import time
+from BCIFront.gui.bciRing import Frame
 
 class bciComms():
     @classmethod
-    def bciConnection(cls, ip, port, toSend, pipe):
-        """ Intended to be run on its own thread or process to connect and receive
-        messages from bci2000.
+    def bciConnection(cls, ip, ports, ring, subscription=None, schemaFile=None,
+            streamDirectory=None, streamControl=None):
+        """ Intended to be run on its own process to accept connections and receive
+        messages from any number of BCI2000 instances. The streams are cut into frames
+        here and every complete frame is parsed and written into the shared ring,
+        tagged with the id of the source it came from. Frames are always written so the
+        ring holds the last few minutes of data for consumers to look back into.
 
         Args:
-            ip, port: specify the BCI2000 app connector output
-            toSend: a process safe boolean that indicate when to send data
-            pipe: a pipe in which to write the data to when toSend is true
+            ip: the address to listen on
+            ports: a port or list of ports specifying the BCI2000 app connector outputs
+            ring: a FrameRing in which to write the frames
+            subscription: the "subscription" setting describing the signal and channel
+            ranges and the state lines to keep. Everything else is dropped here
+            schemaFile: the json file the StreamSchema is cached in
+            streamDirectory: the directory every stream is archived in as it is received
+            streamControl: the StreamControl deciding when the streams are archived
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((ip, port))
-        sock.listen(1)
+        from BCIFront.gui.bciServer import AppConnectorServer
 
-        # Preflight check. BCI2000 opens and then closes the socket
-        conn, addr = sock.accept()
-        conn.close()
-
-        print ip, port
-
-        while True:
-            conn, addr = sock.accept()
-            i = 0
-
-            while True:
-                data = conn.recv(65535)
-                if not data: break
-
-                #i += 1
-                #if i < 10:
-                    #print data
-
-                # toSend is a process-safe boolean value
-                if toSend.value:
-                    pipe.send(data)
-
-            conn.close()
-
-    @classmethod
-    def determineEndRegex(cls, pipe):
-        first =  re.compile(r"Signal\(([0-9]+),([0-9]+)\)")
-        last = ""
-        lastFull = True
-        
-        seenFirst = False
-        maxChan = -1
-        maxSig = -1
-
-        while True:
-            data = pipe.recv()
-
-            for data, full in bciComms.tcpYielder(data):
-                if not full:
-                    last += data
-                    lastFull = False
-                    continue
-                elif full and not lastFull:
-                    lastFull = True
-                    data = last + data
-                    last = ""
-
-                match = first.match(data)
-                if match:
-                    chan = int(match.group(1))
-                    sig = int(match.group(2))
-                    
-                    if seenFirst and chan == 0 and sig == 0:
-                        return "Signal\("+str(maxChan)+","+str(maxSig)+"\)"
-                    
-                    if chan == 0 and sig == 0:
-                        seenFirst = True
-
-                    if chan > maxChan:
-                        maxChan = chan
-
-                    if sig > maxSig:
-                        maxSig = sig
+        if isinstance(ports, int):
+            ports = [ports]
 
+        server = AppConnectorServer(ip, ports, ring, subscription, schemaFile,
+                streamDirectory=streamDirectory, streamControl=streamControl)
+        server.serveForever()
 
     @classmethod
     def processTrainData(cls, trainData, freqList, fileHandle=None):
@@ -91,8 +42,8 @@ class bciComms():
         Args:
             trainData: a dictionary containing trial numbers mapping to a dictionary that has
             freqList: the list of frequencies collected on
-            channels to another dict mapping signal type (EMD/FFT)
-            to an array of collected data ({1:{"12 Hz": "EMD": [1,2,3], ...}})
+            channels to either a (signal, channel, frames) array or a list of the raw
+            app connector lines collected ({1:{"12 Hz": array, ...}})
 
             fileHandle: an open file handle to save the json file to. If not set, the json file
             is not saved
@@ -103,10 +54,14 @@ class bciComms():
         for trial in trainData.keys():
             js[trial] = {}
             for channel in trainData[trial].keys():
-                # Data contains every udp packet received while collecting for
-                # the respective trial/channel
+                # Data contains every frame received while collecting for the
+                # respective trial/channel, either parsed or as raw lines
                 data = trainData[trial][channel]
-                js[trial][channel] = bciComms.rawToDict(data)
+
+                if isinstance(data, numpy.ndarray):
+                    js[trial][channel] = SignalParser.toDict(data)
+                else:
+                    js[trial][channel] = bciComms.rawToDict(data)
 
         js = {"Data": js}
         js["Collected Channels"] = freqList
@@ -125,182 +80,650 @@ class bciComms():
         Args:
             data: array of BCI2000 app connector messages
 
-        Return: a dictionary of {"EMD":{"0": [data], "1":[data]..}...}"""
+        Return: a dictionary of {"EMD":{"0": [data], "1":[data]..}...}
 
-        r = re.compile("Signal\(([0-9]+),([0-9]+)\)[\s]([-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?)")
-        extracted = {}
+        Kept as an adapter over SignalParser for code that still wants the dict form
+        """
 
-        for sig in data:
-            m = r.match(sig)
-            if not m: continue
+        return SignalParser.toDict(SignalParser().parse(data))
 
-            g = m.groups()
-            s = str(g[0]) # Signal
-            c = str(g[1]) # Channel
-            v = float(g[2]) # Value
+    @classmethod
+    def tcpYielder(cls, packet):
+        """ Given a new line separated tcp packet it yields the data until a new line.
+        If the data is not complete it yields all the packet contains and false.
 
-            # Convert Signal to readable name
-            s = {"0": "Raw FFT"}.get(s)
+        Kept for reference and benchmarking, new code should use a LineFramer which
+        also keeps the partial line between packets.
 
-            if s == None: continue
+        Args:
+            packet: The full '\n' separated packet
 
-            # Initializes values if it is the first time
-            if not extracted.has_key(s):
-                extracted[s] = {}
+        Yield: string, bool
+            where the string is data between new line separators or the last of the packet
+            and a boolean saying whether it is the full data
+        """
+        builder = ""
+
+        for char in packet:
+            if char == '\n':
+                temp = builder
+                builder = ""
+                yield temp, True
+            else:
+                builder += char
 
-            if not extracted[s].has_key(c):
-                extracted[s][c] = []
+        yield builder, False
 
-            extracted[s][c].append(v)
 
-        return extracted
+class LineFramer():
+    """ Incrementally splits a stream of new line separated tcp packets into complete
+    lines. Whatever follows the last new line of a packet is kept and prepended to the
+    next packet, so callers never see a partial line.
+    """
 
-    @classmethod
-    def collectData(cls, pipe, duration, headRegex, endRegex, retQueue, lastStamp):
-        """ Collects data from the pipe for a certain duration. Returns the last time
-        stamp of the data collected
+    def __init__(self, separator="\n"):
+        self.separator = separator
+        self.leftover = ""
+
+    def feed(self, packet):
+        """ Adds a packet to the framer
 
         Args:
-            pipe: a pipe to read BCI2000 data from
-            duration: The number of seconds to read data
-            headRegex: A regex string that contains a group with the SourceTime
-            time stamp in it. Used to keep track of elapsed time on the BCI2000
-            machine collecting data
-            endRegex: Regex string matching the end of a grouping of packets used to
-            ensure all data is received
-            retQueue: A process safe queue in which to store the collected data
-            which is just a list of the received data
-            lastStamp: The last time stamp received before the collection starts. An int
+            packet: the raw string received from the socket or pipe
+
+        Return: a list of the complete lines (without separators) that are now available
         """
-        numPackets = int(duration / .5)
-        epsilon = 25
-        duration *= 1000 # Convert from seconds to milliseconds
-        res = []
-        hcomp = re.compile(headRegex)
-        fcomp = re.compile(endRegex)
-        elapsed = 0.0
-        lastFull = True
-        last = ""
-        fullPacket = False
-        count = 0
-
-        # while (elapsed < duration - epsilon) or not fullPacket:
-        while count < numPackets or not fullPacket:
-
-            data = pipe.recv()
-            fullPacket = False
-
-            for data, full in bciComms.tcpYielder(data):
-                if not full:
-                    last += data
-                    lastFull = False
-                    continue
-                elif full and not lastFull:
-                    lastFull = True
-                    data = last + data
-                    last = ""
-
-                # Add full data to list
-                res.append(data+"\n")
-
-                # Checking if all data is received
-                if fcomp.match(data):
-                    fullPacket = True
-
-                # Updating time stamps
-                hmatch = hcomp.match(data)
-                if hmatch:
-                    stamp = int(hmatch.group(1))
-                    count += 1
-
-                    if lastStamp == None:
-                        lastStamp = stamp
-                    else:
-                        temp = bciComms.timeDiff(lastStamp, stamp)
-                        elapsed += temp
-                        lastStamp = stamp
-
-        retQueue.put(res)
-        return lastStamp
+        if self.leftover:
+            packet = self.leftover + packet
+
+        lines = packet.split(self.separator)
+        self.leftover = lines.pop()
+        return lines
+
+    def reset(self):
+        """ Drops any partial line that is being held """
+        self.leftover = ""
 
-    @classmethod
-    def timeDiff(cls, first, second):
-        """ Calculates the ms difference between the two time stamps.
-            The range is from 0-65536ms
 
-            Args:
-                first/second: the two integer time stamps to find the elapsed
-                time between
+class SignalParser():
+    """ Parses the Signal(s,c) value lines of the app connector straight into a
+    (signal, channel, frames) float array. The n-th value seen for a signal and channel
+    pair is written to frame n, which is the same ordering rawToDict used.
+    """
+    lineRegex = re.compile(r"^Signal\(([0-9]+),([0-9]+)\)[ \t]+([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)", re.M)
 
-            Return: Elapsed time from first to second
+    # Readable names for the signals the decoder uses
+    signalNames = {0: "Raw FFT"}
+
+    def __init__(self, signals=None, channels=None):
+        """ Args:
+            signals, channels: the size of the first two dimensions of the parsed array.
+            If None they are inferred from the largest index seen in each call
+        """
+        self.signals = signals
+        self.channels = channels
+
+    def parse(self, data, out=None):
+        """ Parses the signal lines in data. Lines that are not signals are ignored
+
+        Args:
+            data: a list of app connector lines or a string of new line separated lines
+            out: an optional preallocated (signal, channel, frames) array to fill. Frames
+            that do not fit in it are dropped
+
+        Return: a (signal, channel, frames) array with nan where no value was received
         """
-        diff = second - first
-        return diff if diff > 0 else diff + 65536
+        parsed = SignalParser.numbers(data)
+
+        if not len(parsed):
+            shape = (self.signals or 0, self.channels or 0, 0)
+            return out[:, :, :0] if out is not None else numpy.empty(shape)
+
+        sig = parsed[:, 0].astype(int)
+        chan = parsed[:, 1].astype(int)
+        values = parsed[:, 2]
+
+        signals = self.signals if self.signals is not None else sig.max() + 1
+        channels = self.channels if self.channels is not None else chan.max() + 1
+
+        if out is not None:
+            signals, channels = out.shape[0], out.shape[1]
+
+        keep = (sig < signals) & (chan < channels)
+        sig, chan, values = sig[keep], chan[keep], values[keep]
+
+        frame = SignalParser.occurrences(sig * channels + chan)
+        frames = frame.max() + 1 if len(frame) else 0
+
+        if out is None:
+            out = numpy.empty((signals, channels, frames))
+        else:
+            frames = min(frames, out.shape[2])
+            keep = frame < frames
+            sig, chan, values, frame = sig[keep], chan[keep], values[keep], frame[keep]
+
+        out = out[:, :, :frames]
+        out.fill(numpy.nan)
+        out[sig, chan, frame] = values
+        return out
 
     @classmethod
-    def discardTill(cls, pipe, endRegex, headRegex):
-        """ Reads from the pipe until the result matches the regex.
+    def numbers(cls, data):
+        """ Pulls the signal, channel and value out of every signal line
+
+        Return: an (n, 3) float array
+        """
+        if isinstance(data, basestring):
+            data = data.split("\n")
+
+        lines = [l for l in data if l[:7] == "Signal("]
+
+        # Turn "Signal(s,c) v" into "s c v" and let numpy parse the whole block at once
+        text = " ".join(lines).replace("Signal(", " ").replace(",", " ").replace(")", " ")
+        parsed = numpy.fromstring(text, sep=" ")
+
+        if parsed.size != 3 * len(lines):
+            # Something malformed was received so fall back to matching line by line
+            found = cls.lineRegex.findall("\n".join(lines))
+            return numpy.array(found).astype(float).reshape(-1, 3)
 
-        Return: The value in the first group of headRegex
+        return parsed.reshape(-1, 3)
+
+    @classmethod
+    def occurrences(cls, keys):
+        """ Given an array of keys returns for each element how many times its key
+        appeared before it """
+        order = numpy.argsort(keys, kind="mergesort")
+        ordered = keys[order]
+        index = numpy.arange(len(keys))
+
+        starts = numpy.ones(len(keys), dtype=bool)
+        starts[1:] = ordered[1:] != ordered[:-1]
+        groupStart = numpy.maximum.accumulate(numpy.where(starts, index, 0))
+
+        rank = numpy.empty(len(keys), dtype=int)
+        rank[order] = index - groupStart
+        return rank
+
+    @classmethod
+    def toDict(cls, block, names=None):
+        """ Converts a parsed (signal, channel, frames) array to the dictionary
+        format produced by rawToDict ({"Raw FFT": {"0": [data], ...}}). Signals without
+        a readable name are left out
+        """
+        names = cls.signalNames if names is None else names
+        extracted = {}
+
+        for s, name in names.items():
+            if s >= block.shape[0]:
+                continue
+
+            extracted[name] = {}
+
+            for c, row in enumerate(block[s]):
+                row = row[~numpy.isnan(row)]
+                if len(row):
+                    extracted[name][str(c)] = row.tolist()
+
+            if not extracted[name]:
+                del extracted[name]
+
+        return extracted
+
+
+class FrameAssembler():
+    """ Turns the line stream of one source into Frame objects and emits each frame to
+    every subscriber the moment the last Signal(s,c) line of that frame arrives.
+
+    The layout of the stream is learned from the first full cycle of signals. When a
+    cached StreamSchema is given, frames are cut with it straight away and the learned
+    layout only checks it, replacing it if the stream has changed.
+    """
+    first = re.compile(r"Signal\(([0-9]+),([0-9]+)\)")
+
+    def __init__(self, source=0, subscription=None, schema=None, schemaFile=None):
+        """ Args:
+            source: the id given to every frame
+            subscription: a SubscriptionFilter deciding which lines are kept. Keeps
+            everything if not set
+            schema: a cached StreamSchema to start with
+            schemaFile: where to save the learned schema when it differs from the
+            cached one
+        """
+        self.source = source
+        self.filter = subscription if subscription is not None else SubscriptionFilter()
+        self.clock = SourceClock()
+        self.frameSubscribers = []
+        self.schemaSubscribers = []
+        self.schemaFile = schemaFile
+        self.emitted = 0
+        self.lines = []
+        self.schema = None
+        self.parser = None
+        self.endLine = None
+
+        # Used while learning the layout
+        self.verified = False
+        self.seenFirst = False
+        self.maxSig = -1
+        self.maxChan = -1
+        self.states = set()
+
+        if schema is not None:
+            self.useSchema(schema)
+
+    def subscribe(self, onFrame, onSchema=None):
+        """ Args:
+            onFrame: called with every completed Frame
+            onSchema: called with (signals, channels, verified) giving the shape of the
+            published frames whenever the layout is set. verified is False while the
+            layout comes from the cache and has not been checked against the stream
+        """
+        self.frameSubscribers.append(onFrame)
+
+        if onSchema is not None:
+            self.schemaSubscribers.append(onSchema)
+
+            if self.parser is not None:
+                onSchema(self.parser.signals, self.parser.channels, self.verified)
+
+    def useSchema(self, schema):
+        """ Cuts frames using schema from now on and tells the subscribers """
+        self.schema = schema
+        signals, channels = self.filter.shape(schema.signals, schema.channels)
+        self.parser = SignalParser(signals, channels)
+        self.endLine = schema.endLine()
+
+        for onSchema in self.schemaSubscribers:
+            onSchema(signals, channels, self.verified)
+
+    def feed(self, lines, publish=True):
+        """ Adds complete lines to the current frame and emits frames as they complete
 
         Args:
-            pipe: A Connection Object that has a poll and recv method
-            endRegex: A string representing a regular expression, when the regular
-            expression is matched, the method returns.
-            headRegex: A regex string with a grouping. When this string is matched
-            the value is saved and when both a value of the headRegex has been seen
-            and the endRegex is observed, that value is returned
+            lines: the complete lines from a LineFramer
+            publish: if false, completed frames are thrown away
+
+        Return: the list of frames completed by these lines
+        """
+        frames = []
+
+        for line in lines:
+            if not self.verified and self.verify(line):
+                # The rest of this frame has no header, so it is never emitted
+                self.lines = [line]
+                continue
+
+            if self.endLine is None:
+                continue
+
+            if self.filter.keep(line, publish):
+                self.lines.append(line)
+
+            # Frame boundaries come from the unfiltered stream
+            if line.startswith(self.endLine):
+                frame = self.assemble() if publish else None
+                self.lines = []
+
+                if frame is not None:
+                    frames.append(frame)
+                    self.emitted += 1
+
+                    for onFrame in self.frameSubscribers:
+                        onFrame(frame)
+
+        return frames
+
+    def verify(self, line):
+        """ Learns from the line and once the layout is known checks it against the
+        schema in use
+
+        Return: True if the schema in use was replaced by the learned one
+        """
+        learned = self.learn(line)
+        if learned is None:
+            return False
+
+        self.verified = True
+
+        if learned == self.schema:
+            signals, channels = self.parser.signals, self.parser.channels
+            for onSchema in self.schemaSubscribers:
+                onSchema(signals, channels, True)
+
+            return False
+
+        if self.schema is not None:
+            print "Stream layout changed from", self.schema, "to", learned
+
+        self.useSchema(learned)
+
+        if self.schemaFile:
+            learned.save(self.schemaFile)
+
+        return True
+
+    def learn(self, line):
+        """ Looks at the lines until Signal(0,0) has been seen twice, which gives the
+        number of signals and channels and so the last line of a frame
+
+        Return: the learned StreamSchema or None if the cycle is not complete yet
+        """
+        match = FrameAssembler.first.match(line)
+        if not match:
+            self.states.add(line.partition(" ")[0])
+            return None
+
+        sig = int(match.group(1))
+        chan = int(match.group(2))
+
+        if sig == 0 and chan == 0:
+            if self.seenFirst:
+                return StreamSchema(self.maxSig + 1, self.maxChan + 1, sorted(self.states))
+
+            self.seenFirst = True
+
+        self.maxSig = max(sig, self.maxSig)
+        self.maxChan = max(chan, self.maxChan)
+        return None
+
+    def assemble(self):
+        """ Parses the collected lines into a Frame. Frames without a SourceTime header
+        are dropped
+
+        Return: the Frame or None
         """
-        comp = re.compile(endRegex)
-        hComp = re.compile(headRegex)
-        lastFull = True
-        last = ""
         stamp = None
+        states = {}
 
+        # State lines come before the signals of a frame
+        for line in self.lines:
+            if line.startswith("Signal("):
+                break
+
+            name, _, value = line.partition(" ")
+
+            # A state with an empty or malformed value is skipped, and a frame whose
+            # SourceTime is malformed is dropped
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+
+            if name == "SourceTime":
+                stamp = value
+            else:
+                states[name] = value
 
-        while True:
-            data = pipe.recv()
+        if stamp is None:
+            return None
 
-            for data, full in bciComms.tcpYielder(data):
-                if not full:
-                    last += data
-                    lastFull = False
-                    continue
-                elif full and not lastFull:
-                    lastFull = True
-                    data = last + data
-                    last = ""
+        block = numpy.empty((self.parser.signals, self.parser.channels, 1))
+        self.parser.parse(self.lines, block)
 
-                hmatch = hComp.match(data)
-                if hmatch:
-                    stamp = hmatch.group(1)
+        arrival = time()
+        monotonic = self.clock.update(stamp, arrival)
+        return Frame(stamp, states, block[:, :, 0], self.source, arrival, monotonic)
 
-                if comp.match(data) and stamp:
-                    return stamp
+    def reset(self):
+        """ Drops the partially received frame, for example when the connection is lost """
+        self.lines = []
 
 
+class FramePublisher():
+    """ Subscribes to a FrameAssembler in the acquisition process and writes every frame
+    into the next row of a FrameRing """
+
+    def __init__(self, ring, assembler):
+        self.ring = ring
+        self.published = 0
+        assembler.subscribe(self.publish, self.ring.setSchema)
+
+    def publish(self, frame):
+        self.ring.write(frame)
+        self.published += 1
+
+
+class SubscriptionFilter():
+    """ Decides which app connector lines the acquisition process keeps. Signal lines
+    outside the subscribed index ranges and state lines that are not subscribed are
+    dropped before they are parsed or published. Indices are never renumbered, signals
+    and channels below a range are left as nan in the published frame.
+    """
+
+    def __init__(self, signals=None, channels=None, states=("SourceTime",)):
+        """ Args:
+            signals, channels: [first, last] inclusive index ranges to keep. None keeps
+            every index
+            states: the names of the state lines to keep. SourceTime is always kept as
+            frames are timed by it
+        """
+        self.signals = signals
+        self.channels = channels
+        self.states = set(states) | set(["SourceTime"])
+
+        # Decision for every line name ("Signal(0,3)", "SourceTime", ...) seen so far
+        self.decisions = {}
+
+        # Bytes of lines published and thrown away
+        self.forwarded = 0
+        self.dropped = 0
 
     @classmethod
-    def tcpYielder(cls, packet):
-        """ Given a new line separated tcp packet it yields the data until a new line.
-        If the data is not complete it yields all the packet contains and false
+    def fromSettings(cls, settings):
+        """ Builds a filter from the "subscription" setting, a dictionary with the
+        optional keys "signals", "channels" and "states" """
+        if not settings:
+            return cls()
 
-        Args:
-            packet: The full '\n' separated packet
+        return cls(settings.get("signals"), settings.get("channels"),
+                settings.get("states", ["SourceTime"]))
 
-        Yield: string, bool
-            where the string is data between new line separators or the last of the packet
-            and a boolean saying whether it is the full data
+    def keep(self, line, publish=True):
+        """ Return: True if the line should be published. Everything is dropped when
+        publish is false """
+        if not publish:
+            self.dropped += len(line) + 1
+            return False
+
+        name = line.partition(" ")[0]
+
+        try:
+            kept = self.decisions[name]
+        except KeyError:
+            kept = self.decisions[name] = self.decide(name)
+
+        if kept:
+            self.forwarded += len(line) + 1
+        else:
+            self.dropped += len(line) + 1
+
+        return kept
+
+    def decide(self, name):
+        if not name.startswith("Signal("):
+            return name in self.states
+
+        try:
+            sig, chan = [int(i) for i in name[7:-1].split(",")]
+        except ValueError:
+            return False
+
+        return (SubscriptionFilter.inRange(sig, self.signals) and
+                SubscriptionFilter.inRange(chan, self.channels))
+
+    @classmethod
+    def inRange(cls, index, bounds):
+        return bounds is None or bounds[0] <= index <= bounds[1]
+
+    def shape(self, signals, channels):
+        """ Given the number of signals and channels in the stream returns the
+        (signals, channels) that need to be published """
+        if self.signals is not None:
+            signals = min(signals, self.signals[1] + 1)
+
+        if self.channels is not None:
+            channels = min(channels, self.channels[1] + 1)
+
+        return signals, channels
+
+
+class SourceClock():
+    """ Unwraps the SourceTime stamps of one source, which count milliseconds and wrap
+    around, into a monotonic timeline and keeps statistics on the intervals between
+    frames: jitter, gaps, frames lost between BCI2000 and the front end and how far
+    behind the source the frames arrive.
+    """
+    WRAP = 65536
+
+    def __init__(self, wrap=WRAP, period=None, gapRatio=1.5, learnFrames=16):
+        """ Args:
+            wrap: the value at which SourceTime wraps around
+            period: the expected ms between frames. If None it is taken as the median
+            of the first learnFrames intervals
+            gapRatio: an interval longer than gapRatio periods is counted as a gap
+            learnFrames: the number of intervals used to learn the period
         """
-        builder = ""
+        self.wrap = wrap
+        self.fixedPeriod = period
+        self.gapRatio = gapRatio
+        self.learnFrames = learnFrames
+
+        self.last = None
+        self.time = 0
+        self.resume = None # monotonic time of the first frame after a restart
+        self.restart()
+
+    def restart(self):
+        """ Starts the statistics again, for example when the source reconnects and its
+        SourceTime starts again from an arbitrary value, so they only describe the live
+        connection. The monotonic time carries on one period after the last frame """
+        if self.last is not None:
+            self.resume = self.time + int(round(self.period or 0))
+
+        self.period = self.fixedPeriod
+        self.learning = []
+
+        self.last = None
+        self.start = None # (monotonic time, arrival) of the first frame
+
+        # Running mean and sum of squared differences of the intervals
+        self.intervals = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+        self.gaps = 0
+        self.lost = 0
+        self.delay = 0.0
+        self.maxDelay = 0.0
+
+    def update(self, stamp, arrival=None):
+        """ Adds the stamp of the next frame
 
-        for char in packet:
-            if char == '\n':
-                temp = builder
-                builder = ""
-                yield temp, True
-            else:
-                builder += char
+        Args:
+            stamp: the SourceTime of the frame
+            arrival: the time.time() the frame arrived, used to measure the delay
 
-        yield builder, False
+        Return: the monotonic time of the frame in ms. Python integers do not overflow
+        so this keeps counting as long as the session runs
+        """
+        stamp = int(stamp)
+
+        if self.last is None:
+            self.last = stamp
+            self.time = stamp if self.resume is None else self.resume
+            self.start = (self.time, arrival)
+            return self.time
+
+        interval = (stamp - self.last) % self.wrap
+        self.last = stamp
+        self.time += interval
+
+        self.intervals += 1
+        diff = interval - self.mean
+        self.mean += diff / float(self.intervals)
+        self.m2 += diff * (interval - self.mean)
+
+        if self.period is None:
+            self.learning.append(interval)
+            if len(self.learning) >= self.learnFrames:
+                self.period = float(numpy.median(self.learning))
+        elif self.period > 0 and interval > self.gapRatio * self.period:
+            self.gaps += 1
+            self.lost += int(round(interval / self.period)) - 1
+
+        if arrival is not None and self.start[1] is not None:
+            # Positive and growing when frames arrive later and later relative to
+            # when the source produced them
+            self.delay = (arrival - self.start[1]) * 1000 - (self.time - self.start[0])
+            self.maxDelay = max(self.delay, self.maxDelay)
+
+        return self.time
+
+    def jitter(self):
+        """ Return: the standard deviation of the intervals in ms """
+        if self.intervals < 2:
+            return 0.0
+
+        return (self.m2 / (self.intervals - 1)) ** 0.5
+
+    def behind(self, threshold):
+        """ Return: True if frames arrive more than threshold ms later than they did at
+        the start of the session """
+        return self.delay > threshold
+
+    def summary(self):
+        """ Return: a dictionary of the statistics of the session """
+        return {"frames": self.intervals + (self.last is not None), "period": self.period,
+                "meanInterval": self.mean, "jitter": self.jitter(), "gaps": self.gaps,
+                "lost": self.lost, "delay": self.delay, "maxDelay": self.maxDelay}
+
+    def report(self):
+        """ Return: the summary as one line of text """
+        return ("%(frames)d frames, %(meanInterval).1f ms mean interval, %(jitter).1f ms "
+                "jitter, %(gaps)d gaps, %(lost)d lost, %(delay).1f ms delay "
+                "(%(maxDelay).1f max)" % self.summary())
+
+
+class StreamSchema():
+    """ The layout of an app connector stream: the number of signals and channels in
+    each frame and the state lines sent with them. Learned from the stream once and
+    cached in a json file so later startups do not wait for a full BCI2000 cycle.
+    """
+
+    def __init__(self, signals, channels, states=()):
+        self.signals = signals
+        self.channels = channels
+        self.states = list(states)
+
+    def endLine(self):
+        """ Return: the start of the last line of every frame """
+        return "Signal(" + str(self.signals - 1) + "," + str(self.channels - 1) + ")"
+
+    def __eq__(self, other):
+        return (isinstance(other, StreamSchema) and self.signals == other.signals and
+                self.channels == other.channels)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "StreamSchema(%d signals, %d channels, states %s)" % (self.signals,
+                self.channels, self.states)
 
+    @classmethod
+    def load(cls, path):
+        """ Return: the schema saved at path or None if there is none or it is
+        unreadable """
+        try:
+            with open(path, "r") as f:
+                js = json.load(f)
+
+            return cls(int(js["signals"]), int(js["channels"]), js.get("states", []))
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"signals": self.signals, "channels": self.channels,
+                    "states": self.states}, f)
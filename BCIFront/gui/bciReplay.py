@@ -0,0 +1,176 @@
+""" Stands in for BCI2000 by replaying recorded sessions into the front end's app
+connector port, so the ingest, framing and decoding stack can be run and load tested
+without a BCI2000 machine. Run from the repository root:
+
+    python -m BCIFront.gui.bciReplay [--speed N] [--port P] [--loops L] files...
+
+Takes the raw archives (.raw or .index) and binary sessions recorded by
+BciMain.trainingScreen, text dumps of raw app connector lines or the JSON sessions
+written by bciComms.processTrainData. A speed of 0 sends as fast as possible.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+from time import time, sleep
+from BCIFront.gui.bciHelper import LineFramer, SourceClock
+from BCIFront.gui.rawArchive import RawArchive
+from BCIFront.classifier.sessionFile import SessionFile
+
+class Replayer():
+    """ Sends recorded frames to an app connector listener with their original timing,
+    or a multiple of it """
+
+    def __init__(self, frames, speed=1.0, period=500):
+        """ Args:
+            frames: a list of (SourceTime, text) tuples where text holds the new line
+            terminated app connector lines of the frame
+            speed: how many times faster than real time to send, 0 for no waiting
+            period: ms between frames used when the recording has no usable stamps
+        """
+        self.frames = frames
+        self.speed = speed
+        self.period = period
+
+    @classmethod
+    def fromFiles(cls, paths, speed=1.0):
+        """ Loads every path, archives and sessions by their extension and text dumps
+        otherwise, into one replay """
+        frames = []
+
+        for path in paths:
+            base, extension = os.path.splitext(path)
+
+            if extension in (RawArchive.DATA, RawArchive.INDEX):
+                frames.extend(RawArchive(base).frames())
+            elif path.endswith(".json") or path.endswith(SessionFile.EXTENSION):
+                frames.extend(Replayer.loadSession(path))
+            else:
+                frames.extend(Replayer.loadDump(path))
+
+        return cls(frames, speed)
+
+    @classmethod
+    def loadDump(cls, path):
+        """ Splits a raw app connector dump into frames, a frame starting at each
+        SourceTime line
+
+        Return: a list of (SourceTime, text)
+        """
+        with open(path, "r") as f:
+            lines = LineFramer().feed(f.read() + "\n")
+
+        frames = []
+        current = None
+
+        for line in lines:
+            if not line:
+                continue
+
+            if line.startswith("SourceTime"):
+                current = [int(float(line.split()[1])), [line]]
+                frames.append(current)
+            elif current is not None:
+                current[1].append(line)
+
+        return [(stamp, "\n".join(body) + "\n") for stamp, body in frames]
+
+    @classmethod
+    def loadSession(cls, path, period=500):
+        """ Rebuilds frames from a JSON or binary training session. Sessions keep no
+        time stamps so frames are spaced period ms apart, trial after trial
+
+        Return: a list of (SourceTime, text)
+        """
+        if path.endswith(SessionFile.EXTENSION):
+            session = SessionFile(path).toDict()
+        else:
+            with open(path, "r") as f:
+                session = json.load(f)
+
+        frames = []
+        stamp = 0
+
+        for trial in sorted(session["Data"].keys(), key=int):
+            for channel in sorted(session["Data"][trial].keys()):
+                fft = session["Data"][trial][channel]["Raw FFT"]
+                bins = sorted(fft.keys(), key=int)
+                length = min(len(fft[b]) for b in bins)
+
+                for i in range(length):
+                    lines = ["SourceTime " + str(stamp % SourceClock.WRAP)]
+                    lines.extend("Signal(0,%s) %r" % (b, fft[b][i]) for b in bins)
+                    frames.append((stamp % SourceClock.WRAP, "\n".join(lines) + "\n"))
+                    stamp += period
+
+        return frames
+
+    def offsets(self):
+        """ Return: the ms of source time between the first frame and each frame """
+        clock = SourceClock()
+        times = [clock.update(stamp) for stamp, _ in self.frames]
+        return [t - times[0] for t in times]
+
+    def replay(self, host, port, loops=1, preflight=True):
+        """ Connects to the front end and sends the frames
+
+        Args:
+            host, port: the front end's app connector listener
+            loops: how many times to send the recording
+            preflight: open and close a connection first, like BCI2000 does
+
+        Return: (frames sent, bytes sent, seconds taken)
+        """
+        if preflight:
+            socket.create_connection((host, port)).close()
+
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        offsets = self.offsets()
+        span = offsets[-1] + self.period # ms of source time in one loop
+        sent = 0
+        start = time()
+
+        try:
+            for loop in range(loops):
+                for offset, (stamp, text) in zip(offsets, self.frames):
+                    if self.speed > 0:
+                        wait = start + (loop * span + offset) / 1000.0 / self.speed - time()
+                        if wait > 0:
+                            sleep(wait)
+
+                    # Later loops carry on the SourceTime of the recording instead of
+                    # jumping back to its start
+                    if loop:
+                        stamp = (stamp + loop * span) % SourceClock.WRAP
+                        text = "SourceTime " + str(stamp) + text[text.index("\n"):]
+
+                    sock.sendall(text)
+                    sent += len(text)
+        finally:
+            sock.close()
+
+        return len(self.frames) * loops, sent, time() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded sessions as BCI2000")
+    parser.add_argument("files", nargs="+",
+            help="raw archives, text dumps, JSON or binary sessions")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7337)
+    parser.add_argument("--speed", type=float, default=1.0,
+            help="times faster than real time, 0 for as fast as possible")
+    parser.add_argument("--loops", type=int, default=1)
+    args = parser.parse_args()
+
+    replayer = Replayer.fromFiles(args.files, args.speed)
+
+    if not replayer.frames:
+        print "Nothing to replay"
+        sys.exit(1)
+
+    frames, sent, elapsed = replayer.replay(args.host, args.port, args.loops)
+    print "Sent %d frames (%.1f KB) in %.2f s: %.1f frames/s" % (frames, sent / 1024.0,
+            elapsed, frames / max(elapsed, 1e-9))
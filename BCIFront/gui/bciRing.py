@@ -0,0 +1,297 @@
+import ctypes
+import numpy
+from time import time, sleep
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+class FrameRing():
+    """ A fixed size ring buffer of float frames kept in shared memory. A single process
+    (the acquisition process) writes frames and any number of RingReaders, in any
+    process, read them without copying or pickling.
+
+    Every row holds a small header, the values of the subscribed states and then the
+    (signal, channel) values of one frame. The ring must be created before the processes using it are started and
+    passed to them as an argument.
+    """
+    # Columns at the start of every row
+    STAMP = 0    # SourceTime of the frame
+    ARRIVAL = 1  # time.time() when the frame was published
+    SOURCE = 2   # id of the BCI2000 source the frame came from
+    TIME = 3     # monotonic ms time of the frame, see SourceClock
+    STATES = 4   # first state column
+
+    def __init__(self, capacity, width, states=()):
+        """ Args:
+            capacity: the number of frames kept before the oldest is overwritten
+            width: the largest number of signal values a frame can hold
+            states: the names of the states, other than SourceTime, kept with each frame
+        """
+        self.capacity = capacity
+        self.width = width
+        self.states = [s for s in states if s != "SourceTime"]
+        self.header = FrameRing.STATES + len(self.states)
+        self.rowWidth = self.header + width
+        self.buffer = RawArray(ctypes.c_double, capacity * self.rowWidth)
+
+        # Number of frames ever written. Only the writer changes it and only after the
+        # row is complete, so readers never need a lock
+        self.written = RawValue(ctypes.c_longlong, 0)
+
+        # Shape of the signal values, 0 until the writer has learned it from the stream.
+        # Not verified while it comes from a cached schema
+        self.signals = RawValue(ctypes.c_int, 0)
+        self.channels = RawValue(ctypes.c_int, 0)
+        self.verified = RawValue(ctypes.c_bool, False)
+
+        self.view = None
+
+    def __getstate__(self):
+        # The numpy view is rebuilt in every process from the shared buffer
+        state = self.__dict__.copy()
+        state["view"] = None
+        return state
+
+    def rows(self):
+        """ Returns a (capacity, rowWidth) numpy view of the shared memory """
+        if self.view is None:
+            self.view = numpy.frombuffer(self.buffer, dtype=numpy.float64)
+            self.view = self.view.reshape(self.capacity, self.rowWidth)
+
+        return self.view
+
+    def setSchema(self, signals, channels, verified=True):
+        """ Publishes the number of signals and channels in each frame. Every source
+        writing to the ring has to send the same layout, but an unverified layout, one
+        taken from a cache, is replaced by the first verified one """
+        if self.verified.value:
+            if (signals, channels) != self.schema():
+                raise Exception("Stream of " + str((signals, channels)) +
+                        " signals/channels does not match the ring's " + str(self.schema()))
+
+            return
+
+        if signals * channels > self.width:
+            raise Exception("Frames of " + str(signals * channels) +
+                    " values do not fit in a ring of width " + str(self.width))
+
+        self.signals.value = signals
+        self.channels.value = channels
+        self.verified.value = verified
+
+    def schema(self):
+        """ Return: (signals, channels) or (0, 0) if not known yet """
+        return self.signals.value, self.channels.value
+
+    def nextSlot(self):
+        """ Returns the row the next frame is written into. Only the writer should
+        call this, and it should call publish once the row is filled in """
+        return self.rows()[self.written.value % self.capacity]
+
+    def publish(self):
+        """ Makes the row returned by nextSlot visible to the readers """
+        self.written.value += 1
+
+    def write(self, frame):
+        """ Copies a Frame into the next row and publishes it """
+        row = self.nextSlot()
+        row[FrameRing.STAMP] = frame.stamp
+        row[FrameRing.ARRIVAL] = frame.arrival
+        row[FrameRing.SOURCE] = frame.source
+        row[FrameRing.TIME] = frame.monotonic
+
+        for i, name in enumerate(self.states):
+            row[FrameRing.STATES + i] = frame.states.get(name, numpy.nan)
+
+        values = frame.block.ravel()
+        row[self.header:self.header + len(values)] = values
+        self.publish()
+
+    def block(self, rows):
+        """ Given rows read from the ring, returns a (signal, channel, frames) view of
+        their signal values """
+        signals, channels = self.schema()
+        values = rows[:, self.header:self.header + signals * channels]
+        return values.reshape(len(rows), signals, channels).transpose(1, 2, 0)
+
+class Frame():
+    """ One complete block of BCI2000 data """
+
+    def __init__(self, stamp, states, block, source=0, arrival=None, monotonic=None):
+        """ Args:
+            stamp: the SourceTime of the frame
+            states: a dictionary of the other state values received with it
+            block: a (signal, channel) array of the signal values
+            source: the id of the source that sent it
+            arrival: the time.time() the frame was completed, defaults to now
+            monotonic: the unwrapped SourceTime in ms, defaults to the stamp
+        """
+        self.stamp = stamp
+        self.states = states
+        self.block = block
+        self.source = source
+        self.arrival = time() if arrival is None else arrival
+        self.monotonic = stamp if monotonic is None else monotonic
+
+class RingReader():
+    """ A read cursor into a FrameRing. Every consumer keeps its own reader so they can
+    all read the same frames independently """
+
+    def __init__(self, ring, cursor=None, source=None):
+        """ Args:
+            ring: the FrameRing to read from
+            cursor: the number of the first frame to read. Defaults to the next frame
+            that will be written
+            source: if set, only frames from this source id are returned
+        """
+        self.ring = ring
+        self.cursor = ring.written.value if cursor is None else cursor
+        self.source = source
+        self.pending = None
+        self.dropped = 0
+
+    def available(self):
+        """ Returns the number of frames written but not read yet """
+        return self.ring.written.value - self.cursor
+
+    def skip(self):
+        """ Moves the cursor past every frame already written """
+        self.cursor = self.ring.written.value
+        self.pending = None
+
+    def seek(self, when):
+        """ Moves the cursor back to the oldest frame still in the ring that arrived at
+        or after when, so reading can start at a stimulus onset that has already passed.
+        If no such frame arrived yet the cursor is left at the next frame
+
+        Args:
+            when: a time.time() value
+        """
+        written = self.ring.written.value
+        count = min(written, self.ring.capacity)
+        slots = numpy.arange(written - count, written) % self.ring.capacity
+
+        # Frames are written in order of arrival, whichever source they came from
+        arrivals = self.ring.rows()[slots, FrameRing.ARRIVAL]
+        self.cursor = written - count + int(numpy.searchsorted(arrivals, when))
+        self.pending = None
+
+    def read(self, maxFrames=None):
+        """ Reads the unread frames, or at most maxFrames of them.
+
+        If the writer has lapped the reader the overwritten frames are counted in
+        dropped and skipped.
+
+        Return: an (n, rowWidth) array. When the frames are contiguous in the ring this
+        is a view of the shared memory which stays valid until the writer laps it, so
+        copy it if it needs to be kept around. Reading a single source returns a copy
+        """
+        rows = self.readRows(maxFrames)
+
+        if self.source is None:
+            return rows
+
+        return rows[rows[:, FrameRing.SOURCE] == self.source]
+
+    def readRows(self, maxFrames=None):
+        """ Same as read but ignores the source """
+        capacity = self.ring.capacity
+        written = self.ring.written.value
+
+        if written - self.cursor > capacity:
+            self.dropped += written - capacity - self.cursor
+            self.cursor = written - capacity
+
+        end = written if maxFrames is None else min(written, self.cursor + maxFrames)
+        count = end - self.cursor
+        first = self.cursor % capacity
+        rows = self.ring.rows()
+        self.cursor = end
+
+        if first + count <= capacity:
+            return rows[first:first + count]
+
+        return numpy.concatenate((rows[first:], rows[:first + count - capacity]))
+
+    def wait(self, count, interval=0.005):
+        """ Blocks until count frames are unread and returns exactly count of them """
+        if self.source is not None:
+            return self.waitSource(count, interval)
+
+        while self.available() < count:
+            sleep(interval)
+
+        return self.read(count)
+
+    def waitSource(self, count, interval):
+        """ wait for a reader of a single source. Frames of the source that were read
+        past count are kept for the next call """
+        collected = [] if self.pending is None else [self.pending]
+        total = sum(len(c) for c in collected)
+
+        while total < count:
+            if not self.available():
+                sleep(interval)
+                continue
+
+            rows = self.read()
+            collected.append(rows)
+            total += len(rows)
+
+        rows = numpy.concatenate(collected)
+        self.pending = rows[count:]
+        return rows[:count]
+
+class SlidingWindow():
+    """ Keeps the most recent frames of a RingReader and hands out an overlapping window
+    of them every hop frames, so decisions can be made at every new frame instead of
+    once per fixed block """
+
+    def __init__(self, reader, length, hop=1):
+        """ Args:
+            reader: the RingReader frames are taken from
+            length: the number of frames in a window
+            hop: the number of new frames between two windows
+        """
+        self.reader = reader
+        self.length = max(1, int(length))
+        self.hop = max(1, int(hop))
+        self.rows = None
+
+        # Unread frames left after the last window and the seconds between the
+        # arrival of its newest frame and when it was handed out
+        self.backlog = 0
+        self.lag = 0.0
+
+    def next(self):
+        """ Blocks until hop new frames have arrived, or until the first window is full
+
+        Return: a (length, rowWidth) array of the most recent frames, oldest first
+        """
+        if self.rows is None:
+            self.rows = self.reader.wait(self.length).copy()
+        else:
+            rows = self.reader.wait(self.hop)
+            self.rows = numpy.concatenate((self.rows, rows))[-self.length:]
+
+        self.backlog = self.reader.available()
+        self.lag = time() - self.rows[-1, FrameRing.ARRIVAL]
+        return self.rows
+
+    def behind(self):
+        """ Return: True if a whole window's worth of new frames was already waiting,
+        meaning the consumer is slower than the stream and its decisions are stale """
+        return self.backlog >= self.hop
+
+    def block(self):
+        """ Returns a (signal, channel, frames) view of the current window """
+        return self.reader.ring.block(self.rows)
+
+    def average(self):
+        """ Returns the (signal, channel, 1) average of the current window, ignoring
+        values that were not received """
+        block = self.block()
+        counts = (~numpy.isnan(block)).sum(axis=2)[:, :, None]
+        return numpy.nansum(block, axis=2)[:, :, None] / numpy.maximum(counts, 1)
+
+    def clear(self):
+        """ Forgets the frames seen so far, the next window is filled from new frames """
+        self.rows = None
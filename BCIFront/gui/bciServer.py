@@ -0,0 +1,200 @@
+import asyncore
+import socket
+from time import time
+from BCIFront.gui.bciHelper import LineFramer, FrameAssembler, FramePublisher, SubscriptionFilter, StreamSchema
+from BCIFront.gui.rawArchive import RawStreamWriter
+
+class AppConnectorServer():
+    """ Accepts BCI2000 app connector streams on one or more ports and publishes their
+    frames into a FrameRing from a single event loop.
+
+    Each BCI2000 instance is identified by the port it connects to and the host it
+    connects from. Its id, learned layout and counters are kept when it disconnects, so
+    a reconnecting instance (including BCI2000's preflight connection, which opens and
+    closes the socket without sending anything) simply continues as the same source.
+    """
+
+    def __init__(self, ip, ports, ring, subscription=None, schemaFile=None, reportInterval=10,
+            streamDirectory=None, streamControl=None):
+        """ Args:
+            ip: the address to listen on
+            ports: the list of ports to listen on
+            ring: the FrameRing the frames are written to
+            subscription: the "subscription" setting applied to every source
+            schemaFile: the json file the StreamSchema is cached in. A cached schema
+            lets frames be published before a source's layout has been learned
+            reportInterval: seconds between throughput reports
+            streamDirectory: if set, every source's stream is archived here as it is
+            received, see RawStreamWriter
+            streamControl: the StreamControl deciding when the streams are archived.
+            They always are if it is not set
+        """
+        self.ring = ring
+        self.subscription = subscription
+        self.schemaFile = schemaFile
+        self.schema = StreamSchema.load(schemaFile) if schemaFile else None
+        self.streamDirectory = streamDirectory
+        self.streamControl = streamControl
+
+        if self.schema is not None:
+            shape = SubscriptionFilter.fromSettings(subscription).shape(self.schema.signals,
+                    self.schema.channels)
+            ring.setSchema(shape[0], shape[1], False)
+
+        self.reportInterval = reportInterval
+        self.lastReport = time()
+        self.sources = {}
+        self.map = {}
+
+        for port in ports:
+            Listener(self, ip, port)
+            print ip, port
+
+    def source(self, port, host):
+        """ Returns the Source for a connection, creating it the first time """
+        key = (port, host)
+
+        if key not in self.sources:
+            assembler = FrameAssembler(len(self.sources),
+                    SubscriptionFilter.fromSettings(self.subscription), self.schema, self.schemaFile)
+            archive = None
+
+            if self.streamDirectory is not None:
+                archive = RawStreamWriter(RawStreamWriter.streamPath(self.streamDirectory,
+                        assembler.source), control=self.streamControl)
+
+            self.sources[key] = Source(host + ":" + str(port), self.ring, assembler, archive)
+
+        return self.sources[key]
+
+    def serveForever(self):
+        """ Runs the event loop, printing a throughput report every reportInterval """
+        while True:
+            asyncore.loop(timeout=1, map=self.map, count=1)
+
+            for source in self.sources.values():
+                if source.archive is not None:
+                    source.archive.flushIfDue()
+
+            if time() - self.lastReport >= self.reportInterval:
+                print self.report()
+
+    def report(self):
+        """ Return: a string with the throughput of every source since the last report """
+        lines = []
+
+        for source in sorted(self.sources.values(), key=lambda s: s.sourceId):
+            bytesRate, frameRate = source.throughput()
+            subscription = source.assembler.filter
+            lines.append("Source %d (%s) %s: %.1f KB/s, %.1f frames/s, %d connections, "
+                    "%.1f KB forwarded, %.1f KB dropped" %
+                    (source.sourceId, source.name, "up" if source.connection else "down",
+                    bytesRate / 1024.0, frameRate, source.connections,
+                    subscription.forwarded / 1024.0, subscription.dropped / 1024.0))
+            lines.append("    " + source.assembler.clock.report())
+
+        self.lastReport = time()
+        return "\n".join(lines)
+
+class Source():
+    """ Everything known about one BCI2000 instance. Kept across reconnects """
+
+    def __init__(self, name, ring, assembler, archive=None):
+        self.sourceId = assembler.source
+        self.name = name
+        self.assembler = assembler
+        self.archive = archive
+        self.publisher = FramePublisher(ring, self.assembler)
+        self.framer = LineFramer()
+        self.connection = None
+        self.connections = 0
+
+        # Totals and the totals at the last throughput call
+        self.bytes = 0
+        self.mark = (time(), 0, 0)
+
+    def connected(self, connection):
+        """ Makes connection the one the source reads from. An older connection still
+        open for the same source is closed """
+        if self.connection is not None:
+            self.connection.close()
+            self.disconnected()
+
+        self.connection = connection
+        self.connections += 1
+
+    def disconnected(self):
+        """ Drops any partial line or frame of the lost connection and starts the
+        statistics of the source's clock again """
+        self.connection = None
+        self.framer.reset()
+        self.assembler.reset()
+
+        # A restarted BCI2000 counts SourceTime from an arbitrary value
+        self.assembler.clock.restart()
+
+        if self.archive is not None:
+            self.archive.reset()
+
+    def throughput(self):
+        """ Return: (bytes/sec, frames/sec) since the last call """
+        now = time()
+        then, bytes, frames = self.mark
+        elapsed = max(now - then, 1e-9)
+        self.mark = (now, self.bytes, self.publisher.published)
+
+        return ((self.bytes - bytes) / elapsed,
+                (self.publisher.published - frames) / elapsed)
+
+class Listener(asyncore.dispatcher):
+    """ Listens on one port and hands every accepted connection to its Source """
+
+    def __init__(self, server, ip, port):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.port = port
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((ip, port))
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+
+        sock, addr = pair
+        source = self.server.source(self.port, addr[0])
+        SourceConnection(sock, source, self.server)
+
+class SourceConnection(asyncore.dispatcher):
+    """ Reads one app connector stream and feeds it to its Source """
+
+    def __init__(self, sock, source, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.source = source
+        source.connected(self)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(65535)
+        if not data:
+            return
+
+        self.source.bytes += len(data)
+        lines = self.source.framer.feed(data)
+
+        # Archived as received, before the subscription drops anything
+        if self.source.archive is not None:
+            self.source.archive.feed(lines)
+
+        self.source.assembler.feed(lines)
+
+    def handle_close(self):
+        self.close()
+
+        if self.source.connection is self:
+            self.source.disconnected()
@@ -1,7 +1,6 @@
 from BCIFront.gui.bciGUI import drawWidget, Communicate
-from BCIFront.gui.bciHelper import bciComms
+from BCIFront.gui.bciHelper import LineFramer
 from PySide import QtCore
-from multiprocessing import Queue as multiQueue
 import os
 import socket
 import uuid
@@ -50,11 +49,15 @@ class questionsRunScreen():
         return s
 
     def keyPressEvent(self, e):
+        """ The keyboard answers are the true answers to the questions, so the windows
+        the last answer was classified from are learned as that answer """
         print "!!!" + str(e.key())
         if e.key() == QtCore.Qt.Key_Y:
             logging.info("Keyboard: Yes")
+            self.helper.learn("20 Hz")
         elif e.key() == QtCore.Qt.Key_N:
             logging.info("Keyboard: No")
+            self.helper.learn("17 Hz")
             
     def handlePrediction(self, text):
         if self.middle != None:
@@ -94,24 +97,54 @@ class questionsRunScreenHelper(QtCore.QThread):
         self.coms = coms
 
         self.timeout = 5 # seconds till it forces a classification
-        self.period = 0.5 # the time between bci2000 headers
+        self.period = 0.5 * parent.settings.get("hopFrames", 1) # the time between decisions
         self.threshold = 10 # The confidence when to display the classification
 
+        # How much older evidence is weighted by for every new window learned from
+        self.forgetting = parent.settings.get("forgetting", 1.0)
+
+        # The features of the windows of the current question and of the last one
+        # answered, kept until the keyboard says what the answer was or the next
+        # question arrives
+        self.evidence = []
+        self.answered = []
+
+    def learn(self, label):
+        """ Updates the classifier with the windows of the last answered question
+
+        Args:
+            label: the channel that was the true answer
+        """
+        evidence, self.answered = self.answered, []
+
+        if not evidence:
+            return
+
+        try:
+            self.classifier.partialFit(evidence, label, self.forgetting)
+            logging.info("Learned " + str(len(evidence)) + " windows as " + label)
+        except Exception as e:
+            print "Could not update the classifier: " + str(e)
+
     def run(self):
-        self.parent.sendPacket.value = True
-        q = multiQueue()
-        last = bciComms.discardTill(self.parent.pipeReceive, self.parent.endPacketRegex, self.parent.headerRegex)
-        last = int(last)
+        window = self.parent.newWindow()
 
         count = 0
-        priors = self.classifier.priors
+        priors = dict(self.classifier.priors)
 
         while True:
             newQuestion = self.runner.new
 
-            last = bciComms.collectData(self.parent.pipeReceive, self.period, self.parent.headerRegex,
-                    self.parent.endPacketRegex, q, last)
-            data = q.get()
+            # The windows of a question only hold frames from after it arrived, and a
+            # key pressed from now on answers it rather than the last one
+            if newQuestion and count == 0:
+                window.clear()
+                self.answered = []
+
+            window.next()
+
+            if window.behind():
+                print "Falling behind by " + str(window.backlog) + " frames"
 
             # A new question has not arrived
             if not newQuestion:
@@ -121,11 +154,12 @@ class questionsRunScreenHelper(QtCore.QThread):
             # Want to give the user a second to read the text and ignore the brain signals
             if count * self.period < 1.0: continue
 
-            # Takes the raw data and decomposes it into a dict of the corresponding terms
-            processed = bciComms.rawToDict(data)
-            classWith = self.parent.trainingDataFormater.formatFrequencies(processed["Raw FFT"])
-            logging.info(processed["Raw FFT"])
-            
+            # The (signal, channel, 1) average of the frames in the window
+            processed = window.average()
+            classWith = self.parent.trainingDataFormater.formatArray(processed[0])
+            logging.info(processed[0].tolist())
+            self.evidence.append(classWith)
+
 
             probs = None
             try:
@@ -133,9 +167,9 @@ class questionsRunScreenHelper(QtCore.QThread):
             except Exception:
                 continue
 
-            # Updating priors
+            # Updating priors. learn may have added a class since the question started
             for k,v in probs.iteritems():
-                priors[k] *= v
+                priors[k] = priors.get(k, self.classifier.priors.get(k, 0)) * v
 
             # Renormalizing
             s = sum(priors.values())
@@ -149,7 +183,8 @@ class questionsRunScreenHelper(QtCore.QThread):
                 self.coms.txt.emit(highest)
                 self.runner.new = False
                 count = 0
-                priors = self.classifier.priors
+                priors = dict(self.classifier.priors)
+                self.answered, self.evidence = self.evidence, []
 
 class serverConnection(QtCore.QThread):
     def __init__(self, sock, coms):
@@ -158,21 +193,9 @@ class serverConnection(QtCore.QThread):
         self.coms = coms
 
     def run(self):
-        lastFull = True
-        last = ""
+        framer = LineFramer()
 
         while True:
-            data = self.sock.recv(1024)
-
-            for data, full in bciComms.tcpYielder(data):
-                if not full:
-                    last += data
-                    lastFull = False
-                    continue
-                elif full and not lastFull:
-                    lastFull = True
-                    data = last + data
-                    last = ""
-
+            for data in framer.feed(self.sock.recv(1024)):
                 self.coms.txt.emit(data)
 
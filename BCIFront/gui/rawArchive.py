@@ -0,0 +1,422 @@
+""" An archive of raw app connector lines. Frames are stored in zlib compressed chunks
+appended to a .raw file, and every chunk is listed in a .index file of json lines with
+its trial, target, SourceTime range and position, so any trial or time range is read
+back by decompressing only its chunks.
+
+While the training screen records, the acquisition process archives every stream
+exactly as it is received, before any line is filtered or parsed, with a
+RawStreamWriter. The training screen copies the lines of each trial out of it into the
+archive kept with the recording. Run from the repository root:
+
+    python -m BCIFront.gui.rawArchive list archive
+    python -m BCIFront.gui.rawArchive extract archive [--trial T] [--target "17 Hz"]
+    python -m BCIFront.gui.rawArchive session archive output.session
+    python -m BCIFront.gui.rawArchive import archive dumps...
+
+where archive is the path of the archive without its extension.
+"""
+import os
+import sys
+import json
+import zlib
+import ctypes
+import shutil
+import argparse
+from time import time, sleep
+from multiprocessing.sharedctypes import RawValue
+from BCIFront.gui.bciHelper import LineFramer, SignalParser, SourceClock
+
+class RawArchive():
+    """ An append only archive of raw app connector frames with an index by trial,
+    target and SourceTime """
+    DATA = ".raw"
+    INDEX = ".index"
+
+    def __init__(self, path, chunkFrames=64, level=6):
+        """ Opens an archive, creating it if it does not exist
+
+        Args:
+            path: the path of the archive without an extension
+            chunkFrames: the most frames compressed together. Smaller chunks make
+            SourceTime ranges cheaper to read and compress less
+            level: the zlib compression level
+        """
+        self.path = path
+        self.chunkFrames = chunkFrames
+        self.level = level
+        self.index = []
+
+        if os.path.exists(path + RawArchive.INDEX):
+            with open(path + RawArchive.INDEX, "r") as f:
+                for line in f:
+                    if line.strip():
+                        self.index.append(json.loads(line))
+
+    @classmethod
+    def splitFrames(cls, lines):
+        """ Groups lines into frames, each starting at a SourceTime line. Lines before
+        the first SourceTime line are dropped
+
+        Return: a list of (SourceTime, [lines])
+        """
+        frames = []
+
+        for line in lines:
+            if line.startswith("SourceTime"):
+                try:
+                    frames.append((int(float(line.split()[1])), [line]))
+                    continue
+                except (ValueError, IndexError):
+                    pass
+
+            if frames:
+                frames[-1][1].append(line)
+
+        return frames
+
+    def append(self, lines, trial=None, target=None, received=None):
+        """ Compresses and appends frames to the archive
+
+        Args:
+            lines: new line terminated app connector lines holding whole frames
+            trial, target: what the frames were recorded for
+            received: the (first, last) time.time() the frames were received, kept in
+            the index so a SourceTime range can be told apart from the same range
+            after SourceTime wrapped
+        """
+        frames = RawArchive.splitFrames(lines)
+
+        with open(self.path + RawArchive.DATA, "ab") as data:
+            with open(self.path + RawArchive.INDEX, "a") as index:
+                for start in range(0, len(frames), self.chunkFrames):
+                    chunk = frames[start:start + self.chunkFrames]
+                    text = "".join("".join(body) for stamp, body in chunk)
+                    compressed = zlib.compress(text, self.level)
+
+                    data.seek(0, 2)
+                    entry = {"trial": trial, "target": target, "first": chunk[0][0],
+                             "last": chunk[-1][0], "frames": len(chunk),
+                             "offset": data.tell(), "length": len(compressed),
+                             "size": len(text)}
+
+                    if received is not None:
+                        entry["received"] = list(received)
+
+                    # On disk before the index lists it, for readers in other processes
+                    data.write(compressed)
+                    data.flush()
+
+                    index.write(json.dumps(entry, sort_keys=True) + "\n")
+                    self.index.append(entry)
+
+    @classmethod
+    def inRange(cls, stamp, since, until):
+        """ Return: True if the SourceTime stamp is within [since, until]. A range
+        whose until is below its since wraps around the end of SourceTime """
+        since = 0 if since is None else since
+        until = SourceClock.WRAP - 1 if until is None else until
+
+        if since <= until:
+            return since <= stamp <= until
+
+        return stamp >= since or stamp <= until
+
+    @classmethod
+    def overlaps(cls, entry, since, until):
+        """ Return: True if a chunk holds SourceTimes within [since, until]. Either range
+        may wrap, and two such ranges overlap when one holds the start of the other """
+        since = 0 if since is None else since
+        return (cls.inRange(entry["first"], since, until) or
+                cls.inRange(since, entry["first"], entry["last"]))
+
+    def refresh(self):
+        """ Reads the entries appended to the index since it was read, such as the ones
+        another process is writing """
+        if not os.path.exists(self.path + RawArchive.INDEX):
+            return
+
+        with open(self.path + RawArchive.INDEX, "r") as f:
+            lines = [l for l in f if l.strip()]
+
+        for line in lines[len(self.index):]:
+            # The last line may still be being written
+            try:
+                self.index.append(json.loads(line))
+            except ValueError:
+                break
+
+    def waitFor(self, stamp, received, timeout, interval=0.1):
+        """ Blocks until the archive, written by another process, holds a chunk with the
+        frame of a SourceTime received in a time range, or until timeout seconds pass
+
+        Args:
+            stamp: the SourceTime of the frame
+            received: the (first, last) time.time() range it was received in
+
+        Return: True if the frame was archived
+        """
+        deadline = time() + timeout
+
+        while True:
+            self.refresh()
+
+            if self.entries(since=stamp, until=stamp, received=received):
+                return True
+
+            if time() >= deadline:
+                return False
+
+            sleep(interval)
+
+    def entries(self, trial=None, target=None, since=None, until=None, received=None):
+        """ Return: the index entries of the chunks that may hold matching frames. If
+        received, a (first, last) time.time() range, is set only chunks received within
+        it match """
+        return [e for e in self.index
+                if (trial is None or e["trial"] == trial) and
+                   (target is None or e["target"] == target) and
+                   RawArchive.overlaps(e, since, until) and
+                   (received is None or ("received" in e and
+                        e["received"][0] <= received[1] and e["received"][1] >= received[0]))]
+
+    def readChunk(self, entry, data):
+        data.seek(entry["offset"])
+        return zlib.decompress(data.read(entry["length"]))
+
+    def frames(self, trial=None, target=None, since=None, until=None, received=None):
+        """ Reads the matching frames. Only the chunks listed for them are read
+
+        Args:
+            trial, target: only frames recorded for these
+            since, until: only frames whose SourceTime is in this inclusive range
+            received: only frames of chunks received in this time.time() range
+
+        Return: a list of (SourceTime, text) where text holds the new line terminated
+        lines of the frame, in the order they were archived
+        """
+        found = []
+        entries = self.entries(trial, target, since, until, received)
+
+        if not entries:
+            return found
+
+        with open(self.path + RawArchive.DATA, "rb") as data:
+            for entry in entries:
+                lines = LineFramer().feed(self.readChunk(entry, data))
+
+                for stamp, body in RawArchive.splitFrames(lines):
+                    if RawArchive.inRange(stamp, since, until):
+                        found.append((stamp, "\n".join(body) + "\n"))
+
+        return found
+
+    def lines(self, trial=None, target=None, since=None, until=None, received=None):
+        """ Same as frames but returns the new line terminated lines """
+        lines = []
+
+        for stamp, text in self.frames(trial, target, since, until, received):
+            lines.extend(l + "\n" for l in text.split("\n")[:-1])
+
+        return lines
+
+    def keys(self):
+        """ Return: the (trial, target) pairs in the archive, in the order they were
+        first archived """
+        keys = []
+
+        for e in self.index:
+            if (e["trial"], e["target"]) not in keys:
+                keys.append((e["trial"], e["target"]))
+
+        return keys
+
+    def toDict(self, freqList=None):
+        """ Parses the archived frames into the training dictionary written by
+        bciComms.processTrainData, so they can be analysed again
+
+        Args:
+            freqList: the list of frequencies collected on. Defaults to the frequencies
+            of the targets
+        """
+        data = {}
+
+        for trial, target in self.keys():
+            block = SignalParser().parse([l.rstrip("\n") for l in self.lines(trial, target)])
+            data.setdefault(str(trial), {})[target] = SignalParser.toDict(block)
+
+        if freqList is None:
+            freqList = sorted(set(int(str(t).split(" ")[0]) for trial, t in self.keys()
+                    if str(t).split(" ")[0].isdigit()))
+
+        return {"Data": data, "Collected Channels": freqList}
+
+    def clear(self):
+        """ Deletes everything in the archive """
+        for extension in (RawArchive.DATA, RawArchive.INDEX):
+            if os.path.exists(self.path + extension):
+                os.remove(self.path + extension)
+
+        self.index = []
+
+    def move(self, path):
+        """ Moves the archive to a new path without an extension """
+        for extension in (RawArchive.DATA, RawArchive.INDEX):
+            if os.path.exists(self.path + extension):
+                shutil.move(self.path + extension, path + extension)
+
+        self.path = path
+
+class StreamControl():
+    """ Tells the RawStreamWriters of the acquisition process when to archive. It lives in
+    shared memory, so it must be created before the acquisition process is started and
+    passed to it as an argument """
+
+    def __init__(self):
+        # Frames whose SourceTime line is received at or before this time.time() are
+        # archived. 0 until a recording starts, infinite while one is running
+        self.until = RawValue(ctypes.c_double, 0)
+
+    def start(self):
+        """ Archives every frame from now on, in archives started afresh """
+        self.until.value = float("inf")
+
+    def stop(self, until):
+        """ Stops archiving after the frames received at or before until. Those are
+        written as soon as they are complete, that is when the next frame starts """
+        self.until.value = until
+
+class RawStreamWriter():
+    """ Archives an app connector stream as it is received, in the acquisition process,
+    before its lines are filtered or parsed. Complete frames are buffered until
+    chunkFrames of them are ready or the oldest has waited flushSeconds, and every chunk
+    is indexed with the times its frames were received """
+
+    def __init__(self, path, chunkFrames=64, flushSeconds=5.0, level=6, control=None):
+        """ Starts a new archive at path, deleting what was there
+
+        Args:
+            path: the path of the archive without an extension, see streamPath
+            chunkFrames, level: see RawArchive
+            flushSeconds: the longest a complete frame waits before it is written
+            control: a StreamControl deciding when frames are archived. Every frame is
+            if it is not set
+        """
+        self.archive = RawArchive(path, chunkFrames, level)
+        self.archive.clear()
+        self.flushSeconds = flushSeconds
+        self.control = control
+        self.active = control is None
+
+        # (time received, [lines]) of the complete frames not written yet and of the
+        # frame being received
+        self.frames = []
+        self.current = None
+
+    @classmethod
+    def streamPath(cls, directory, source):
+        """ Return: the path of the archive of a source id's stream in directory """
+        return os.path.join(directory, "stream%d" % source)
+
+    def archiving(self, arrival):
+        """ Return: True if a frame received at arrival is archived. The first frame of
+        a recording deletes what the last recording archived """
+        if self.control is None:
+            return True
+
+        if arrival > self.control.until.value:
+            self.active = False
+            return False
+
+        if not self.active:
+            self.archive.clear()
+            self.active = True
+
+        return True
+
+    def feed(self, lines, arrival=None):
+        """ Adds received lines, without their new lines. A frame is complete when the
+        SourceTime line of the next one arrives. Lines before the first SourceTime
+        line are dropped, as is every frame received while not archiving """
+        arrival = time() if arrival is None else arrival
+
+        for line in lines:
+            if line.startswith("SourceTime"):
+                if self.current is not None:
+                    self.frames.append(self.current)
+
+                self.current = (arrival, [line + "\n"]) if self.archiving(arrival) else None
+            elif self.current is not None:
+                self.current[1].append(line + "\n")
+
+        # Once a recording stops its last frames are written straight away
+        if len(self.frames) >= self.archive.chunkFrames or not self.active:
+            self.flush()
+        else:
+            self.flushIfDue(arrival)
+
+    def flushIfDue(self, now=None):
+        """ Writes the complete frames if the oldest has waited flushSeconds """
+        now = time() if now is None else now
+
+        if self.frames and now - self.frames[0][0] >= self.flushSeconds:
+            self.flush()
+
+    def flush(self):
+        """ Writes the complete frames """
+        frames, self.frames = self.frames, []
+
+        if frames:
+            self.archive.append([l for _, body in frames for l in body],
+                    received=(frames[0][0], frames[-1][0]))
+
+    def reset(self):
+        """ Drops the frame being received, for example when the connection is lost """
+        self.current = None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Raw app connector archives")
+    commands = parser.add_subparsers(dest="command")
+
+    listing = commands.add_parser("list", help="show the chunks of an archive")
+    listing.add_argument("archive")
+
+    extract = commands.add_parser("extract", help="print the raw lines of frames")
+    extract.add_argument("archive")
+    extract.add_argument("--trial", type=int)
+    extract.add_argument("--target")
+    extract.add_argument("--since", type=int, help="first SourceTime")
+    extract.add_argument("--until", type=int, help="last SourceTime")
+
+    session = commands.add_parser("session", help="convert to a json or binary session")
+    session.add_argument("archive")
+    session.add_argument("output")
+
+    importing = commands.add_parser("import", help="archive text dumps, one target each")
+    importing.add_argument("archive")
+    importing.add_argument("dumps", nargs="+")
+    args = parser.parse_args()
+
+    archive = RawArchive(args.archive)
+
+    if args.command == "list":
+        for e in archive.index:
+            print "trial %-4s %-10s SourceTime %5d-%5d %4d frames %8d -> %7d bytes" % (
+                    e["trial"], e["target"], e["first"], e["last"], e["frames"],
+                    e["size"], e["length"])
+    elif args.command == "extract":
+        sys.stdout.write("".join(archive.lines(args.trial, args.target, args.since,
+                args.until)))
+    elif args.command == "session":
+        from BCIFront.classifier.sessionFile import SessionFile
+
+        js = archive.toDict()
+        if args.output.endswith(SessionFile.EXTENSION):
+            SessionFile.fromDict(js, args.output)
+        else:
+            with open(args.output, "w") as f:
+                json.dump(js, f, indent=4, separators=(',', ': '))
+    elif args.command == "import":
+        for path in args.dumps:
+            with open(path, "r") as f:
+                archive.append([l + "\n" for l in LineFramer().feed(f.read() + "\n")],
+                        target=os.path.basename(path))